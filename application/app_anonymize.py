@@ -0,0 +1,221 @@
+"""
+Bulk anonymization, copies only the critical chunks of every PNG file:
+    python3 app_anonymize.py <path> [<path> ...] -o <output dir> [-j 8] [--check-crcs]
+Files are never parsed into Png objects and pixel data is never decoded:
+chunk headers are read one by one, ancilliary chunks and data after IEND
+are skipped and IDAT payloads are copied by the kernel (copy_file_range or
+sendfile) where it can, in buffered blocks otherwise. The CRCs of IHDR,
+PLTE and IEND are recomputed, with --check-crcs the IDAT ones as well (the
+payloads are then read). Output mirrors the input directory tree, one JSON
+line per file goes to stdout, progress and bytes saved to stderr.
+"""
+import argparse
+import errno
+import json
+import logging as log
+import os
+import struct
+import sys
+import zlib
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from app_metadata import PNG_SIGNATURE, BatchStats, batched, find_png_files
+
+CRITICAL_CHUNK_TYPES = ('IHDR', 'PLTE', 'IDAT', 'IEND')
+# length and type
+CHUNK_HEADER_SIZE = 8
+CRC_SIZE = 4
+COPY_BUFFER_SIZE = 1 << 20
+# errors of copy_file_range and sendfile meaning "not between these files"
+COPY_FALLBACK_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF)
+
+
+def copy_range(src_fd: int, dst_fd: int, offset: int, length: int):
+    """
+    Appends length bytes of src_fd from offset at the position of dst_fd,
+    copy_file_range, sendfile or buffered reads, whichever works first
+    """
+    end = offset + length
+    for kernel_copy in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, kernel_copy):
+            continue
+        try:
+            while offset < end:
+                if kernel_copy == 'copy_file_range':
+                    copied = os.copy_file_range(src_fd, dst_fd, end - offset, offset)
+                else:
+                    copied = os.sendfile(dst_fd, src_fd, offset, end - offset)
+                if copied == 0:
+                    log.error("Unexpected end of file")
+                    raise Exception("File error")
+                offset += copied
+            return
+        except OSError as error:
+            if error.errno not in COPY_FALLBACK_ERRORS:
+                raise
+    while offset < end:
+        data = os.pread(src_fd, min(COPY_BUFFER_SIZE, end - offset), offset)
+        if not data:
+            log.error("Unexpected end of file")
+            raise Exception("File error")
+        os.write(dst_fd, data)
+        offset += len(data)
+
+
+def copy_with_crc(src_fd: int, dst_fd: int, offset: int, length: int, crc: int) -> int:
+    """
+    Appends length bytes of src_fd from offset to dst_fd in buffered blocks
+    ## Returns:
+        - int: crc updated with the copied bytes
+    """
+    end = offset + length
+    while offset < end:
+        data = os.pread(src_fd, min(COPY_BUFFER_SIZE, end - offset), offset)
+        if not data:
+            log.error("Unexpected end of file")
+            raise Exception("File error")
+        os.write(dst_fd, data)
+        crc = zlib.crc32(data, crc)
+        offset += len(data)
+    return crc
+
+
+def anonymize_file(input_path: str, output_path: str, check_crcs: bool = False) -> dict:
+    """
+    Writes the signature and the critical chunks of input_path to output_path
+    ## Args:
+        - check_crcs (bool, optional): reads the IDAT payloads to recompute their
+          CRCs too, instead of copying them in the kernel
+    ## Returns:
+        - dict: paths, sizes, bytes saved, removed chunk types, number of fixed CRCs
+    """
+    if os.path.exists(output_path) and os.path.samefile(input_path, output_path):
+        log.error("Output %s is the input file", output_path)
+        raise Exception("File error")
+    removed = []
+    crc_fixed = 0
+    with open(input_path, 'rb', buffering=0) as src, open(output_path, 'wb', buffering=0) as dst:
+        src_fd = src.fileno()
+        dst_fd = dst.fileno()
+        size = os.fstat(src_fd).st_size
+        if os.pread(src_fd, len(PNG_SIGNATURE), 0) != PNG_SIGNATURE:
+            log.error("Invalid PNG signature in %s", input_path)
+            raise Exception("Invalid PNG signature")
+        os.write(dst_fd, PNG_SIGNATURE)
+        offset = len(PNG_SIGNATURE)
+        chunk_type = None
+        while chunk_type != 'IEND':
+            if offset + CHUNK_HEADER_SIZE + CRC_SIZE > size:
+                log.error("Missing IEND chunk in %s", input_path)
+                raise Exception("Corrupted data")
+            header = os.pread(src_fd, CHUNK_HEADER_SIZE, offset)
+            length, raw_type = struct.unpack('>I4s', header)
+            chunk_type = raw_type.decode('latin-1')
+            data_offset = offset + CHUNK_HEADER_SIZE
+            chunk_end = data_offset + length + CRC_SIZE
+            if chunk_end > size:
+                log.error("Chunk %s runs past the end of %s", chunk_type, input_path)
+                raise Exception("Corrupted data")
+            if chunk_type not in CRITICAL_CHUNK_TYPES:
+                removed.append(chunk_type)
+            elif chunk_type == 'IDAT' and not check_crcs:
+                copy_range(src_fd, dst_fd, offset, chunk_end - offset)
+            else:
+                os.write(dst_fd, header)
+                crc = copy_with_crc(src_fd, dst_fd, data_offset, length, zlib.crc32(raw_type))
+                if int.from_bytes(os.pread(src_fd, CRC_SIZE, data_offset + length), 'big') != crc:
+                    crc_fixed += 1
+                os.write(dst_fd, crc.to_bytes(CRC_SIZE, 'big'))
+            offset = chunk_end
+        output_size = os.fstat(dst_fd).st_size
+    return {"path": input_path, "output": output_path, "size": size, "output_size": output_size,
+            "saved_bytes": size - output_size, "removed": removed, "crc_fixed": crc_fixed}
+
+
+def find_png_pairs(roots: list, output_dir: str):
+    """ Yields (input path, output path), output paths mirror the tree under every root """
+    for root in roots:
+        base = root if os.path.isdir(root) else os.path.dirname(root)
+        for path in find_png_files([root]):
+            yield path, os.path.join(output_dir, os.path.relpath(path, base))
+
+
+def anonymize_batch(pairs: list, check_crcs: bool = False) -> list:
+    results = []
+    for input_path, output_path in pairs:
+        try:
+            os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+            results.append(anonymize_file(input_path, output_path, check_crcs))
+        except Exception as e:
+            results.append({"path": input_path, "error": f"{type(e).__name__}: {e}"})
+    return results
+
+
+class AnonymizeStats(BatchStats):
+    def __init__(self):
+        super().__init__()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def add(self, results: list):
+        for result in results:
+            if "error" not in result:
+                self.bytes_in += result["size"]
+                self.bytes_out += result["output_size"]
+        super().add(results)
+
+    def report(self):
+        super().report()
+        saved = self.bytes_in - self.bytes_out
+        share = saved / self.bytes_in if self.bytes_in else 0.0
+        print(f"{self.bytes_in / 1e6:.1f} MB in, {self.bytes_out / 1e6:.1f} MB out, "
+              f"{saved / 1e6:.1f} MB saved ({share:.1%})", file=sys.stderr)
+
+
+def run_batch(pairs, output, jobs: int = None, batch_size: int = 64, max_pending: int = None,
+              check_crcs: bool = False) -> AnonymizeStats:
+    """
+    Anonymizes (input path, output path) pairs on a process pool, writing
+    results as batches complete (see app_metadata.run_batch)
+    """
+    jobs = jobs or os.cpu_count()
+    max_pending = max_pending or 4 * jobs
+    stats = AnonymizeStats()
+
+    def collect(future):
+        for result in future.result():
+            output.write(json.dumps(result) + '\n')
+        stats.add(future.result())
+
+    with ProcessPoolExecutor(jobs) as executor:
+        pending = set()
+        for batch in batched(pairs, batch_size):
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(future)
+            pending.add(executor.submit(anonymize_batch, batch, check_crcs))
+        for future in pending:
+            collect(future)
+    stats.report()
+    return stats
+
+
+if __name__ == '__main__':
+    log.basicConfig(
+        format='%(levelname)s {%(pathname)s:%(lineno)d} %(asctime)s %(message)s', level=log.CRITICAL)
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help='directories (walked recursively) or files')
+    parser.add_argument('-o', '--output-dir', required=True, help='directory of the anonymized files')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes (default: number of CPUs)')
+    parser.add_argument('--check-crcs', action='store_true',
+                        help='recompute IDAT CRCs as well (reads the image data)')
+    parser.add_argument('--batch-size', type=int, default=64,
+                        help='files anonymized per worker task')
+    parser.add_argument('--max-pending', type=int, default=None,
+                        help='queued tasks limit (default: 4 per worker)')
+    args = parser.parse_args()
+
+    run_batch(find_png_pairs(args.paths, args.output_dir), sys.stdout, jobs=args.jobs,
+              batch_size=args.batch_size, max_pending=args.max_pending, check_crcs=args.check_crcs)
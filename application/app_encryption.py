@@ -37,11 +37,11 @@ if __name__ == '__main__':
     # cv.imshow('Encrypted', enc)
     # cv.imshow('Decrypted', dec)
 
-    encrypted_cfb = png.EncryptedPng(original_png_path)
-    iv, public_key, private_key = encrypted_cfb.encrypt_cfb(ENCRYPTED_CFB_PATH)
+    with png.EncryptedPng(original_png_path) as encrypted_cfb:
+        iv, public_key, private_key = encrypted_cfb.encrypt_cfb(ENCRYPTED_CFB_PATH)
 
-    decrypted_cfb = png.EncryptedPng(ENCRYPTED_CFB_PATH, public_key=public_key, private_key=private_key)
-    decrypted_cfb.decrypt_cfb(DECRYPTED_CFB_PATH, iv)
+    with png.EncryptedPng(ENCRYPTED_CFB_PATH, public_key=public_key, private_key=private_key) as decrypted_cfb:
+        decrypted_cfb.decrypt_cfb(DECRYPTED_CFB_PATH, iv)
 
     enc = cv.imread(ENCRYPTED_CFB_PATH)
     dec = cv.imread(DECRYPTED_CFB_PATH)
@@ -0,0 +1,143 @@
+"""
+Batch metadata extraction over directory trees, one JSON line per PNG file:
+    python3 app_metadata.py <path> [<path> ...] [-j 8] [-o metadata.ndjson]
+Files which cannot be parsed get a line with an "error" key instead.
+Progress and throughput go to stderr.
+"""
+import argparse
+import json
+import logging as log
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import png_class as png
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PROGRESS_INTERVAL = 5.0
+
+
+def find_png_files(roots: list):
+    """ Yields paths of all .png files under roots (files are yielded as given) """
+    for root in roots:
+        if os.path.isfile(root):
+            yield root
+            continue
+        for dir_path, _, file_names in os.walk(root):
+            for name in file_names:
+                if name.lower().endswith('.png'):
+                    yield os.path.join(dir_path, name)
+
+
+def extract_metadata(path: str) -> dict:
+    """ Reads IHDR and ancilliary chunks only, image data is never touched:
+        the file is opened once and read in one pass, IDAT chunks are skipped
+    """
+    png_file = png.Png.open(path, lazy=True)
+    return {
+        "path": path,
+        "size": os.path.getsize(path),
+        "signature_ok": bytes(png_file.get_signature()) == PNG_SIGNATURE,
+        "ihdr": png_file.get_ihdr_chunk().get_hdr_data()._asdict(),
+        "ancilliary": png_file.get_ancilliary_dict(),
+        "chunk_numbers": png_file.get_all_chunk_numbers(),
+        "critical_chunks_ok": png_file.check_critical_chunk_numbers(),
+    }
+
+
+def extract_batch(paths: list) -> list:
+    results = []
+    for path in paths:
+        try:
+            results.append(extract_metadata(path))
+        except Exception as e:
+            results.append({"path": path, "error": f"{type(e).__name__}: {e}"})
+    return results
+
+
+def batched(iterable, size: int):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class BatchStats:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.last_report = self.start
+        self.files = 0
+        self.errors = 0
+
+    def add(self, results: list):
+        self.files += len(results)
+        self.errors += sum(1 for result in results if "error" in result)
+        now = time.perf_counter()
+        if now - self.last_report >= PROGRESS_INTERVAL:
+            self.last_report = now
+            self.report()
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start
+        rate = self.files / elapsed if elapsed > 0 else 0.0
+        print(f"{self.files} files, {self.errors} errors, {elapsed:.1f} s, {rate:.1f} files/s",
+              file=sys.stderr)
+
+
+def write_results(results: list, output):
+    for result in results:
+        output.write(json.dumps(result, default=str) + '\n')
+
+
+def run_batch(paths, output, jobs: int = None, batch_size: int = 64, max_pending: int = None) -> BatchStats:
+    """
+    Parses paths on a process pool, writing results as batches complete
+    At most max_pending batches are queued, so the walk over the directory
+    tree never runs far ahead of the workers
+    """
+    jobs = jobs or os.cpu_count()
+    max_pending = max_pending or 4 * jobs
+    stats = BatchStats()
+    with ProcessPoolExecutor(jobs) as executor:
+        pending = set()
+        for batch in batched(paths, batch_size):
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    write_results(future.result(), output)
+                    stats.add(future.result())
+            pending.add(executor.submit(extract_batch, batch))
+        for future in pending:
+            write_results(future.result(), output)
+            stats.add(future.result())
+    stats.report()
+    return stats
+
+
+if __name__ == '__main__':
+    log.basicConfig(
+        format='%(levelname)s {%(pathname)s:%(lineno)d} %(asctime)s %(message)s', level=log.CRITICAL)
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help='directories (walked recursively) or files')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes (default: number of CPUs)')
+    parser.add_argument('-o', '--output', default='-',
+                        help='NDJSON output file (default: stdout)')
+    parser.add_argument('--batch-size', type=int, default=64,
+                        help='files parsed per worker task')
+    parser.add_argument('--max-pending', type=int, default=None,
+                        help='queued tasks limit (default: 4 per worker)')
+    args = parser.parse_args()
+
+    output = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        run_batch(find_png_files(args.paths), output, jobs=args.jobs,
+                  batch_size=args.batch_size, max_pending=args.max_pending)
+    finally:
+        if output is not sys.stdout:
+            output.close()
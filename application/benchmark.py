@@ -0,0 +1,552 @@
+"""
+Performance benchmarks, run from the application directory:
+    python3 benchmark.py unfilter
+    python3 benchmark.py crc
+    python3 benchmark.py memory
+    python3 benchmark.py rsa
+    python3 benchmark.py stream-memory [--megapixels 4 9 16]
+    python3 benchmark.py filters
+    python3 benchmark.py deflate [--threads 1 2 4]
+    python3 benchmark.py pipeline
+    python3 benchmark.py suite -o results.json [--megapixels 1 10 100]
+    python3 benchmark.py compare baseline.json results.json
+"""
+import argparse
+import contextlib
+import gc
+import glob
+import io
+import json
+import logging as log
+import math
+import os
+import platform
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+import numpy as np
+import chunk_class as chunk
+import filters
+import png_class as png
+from encoder import PngEncoder
+from encryption import rsa2048, generate_keypair
+
+PICTURES_GLOB = 'pictures/*.png'
+
+CHANNELS_BY_COLOR_TYPE = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+SYNTHETIC_SIZES = [(1024, 1024), (1920, 1080), (3840, 2160)]
+
+SUITE_MEGAPIXELS = [1, 4]
+SUITE_COLOR_TYPES = [0, 2, 3, 4, 6]
+# stages slower than this by more than the threshold are regressions
+REGRESSION_THRESHOLD = 0.10
+REGRESSION_MIN_SECONDS = 0.001
+
+
+def legacy_defilter(data_to_defilter: bytes, height: int, stride: int, bytes_per_pixel: int) -> bytes:
+    """ The byte-by-byte reconstruction EncryptedPng.defilter_data used before
+        the filters module, kept as the baseline
+    """
+    reconstructed_idat_data = b''
+
+    def recon_a(r, c):
+        return reconstructed_idat_data[r * stride + c - bytes_per_pixel] if c >= bytes_per_pixel else 0
+
+    def recon_b(r, c):
+        return reconstructed_idat_data[(r-1) * stride + c] if r > 0 else 0
+
+    def recon_c(r, c):
+        return reconstructed_idat_data[(r-1) * stride + c - bytes_per_pixel] if r > 0 and c >= bytes_per_pixel else 0
+
+    i = 0
+    for r in range(height):
+        filter_type = data_to_defilter[i]
+        i += 1
+        for c in range(stride):
+            filt_x = data_to_defilter[i]
+            i += 1
+            if filter_type == 0:
+                recon_x = filt_x
+            elif filter_type == 1:
+                recon_x = filt_x + recon_a(r, c)
+            elif filter_type == 2:
+                recon_x = filt_x + recon_b(r, c)
+            elif filter_type == 3:
+                recon_x = filt_x + (recon_a(r, c) + recon_b(r, c)) // 2
+            else:
+                recon_x = filt_x + \
+                    filters.paeth_predictor(
+                        recon_a(r, c), recon_b(r, c), recon_c(r, c))
+            reconstructed_idat_data += bytes([recon_x & 0xFF])
+    return reconstructed_idat_data
+
+
+def timed(function, *args, repeat: int = 1):
+    """ Returns (best wall time in seconds, result of the last call) """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def picture_scanlines(path: str) -> tuple:
+    """ Returns (name, decompressed IDAT data, height, stride, bytes per pixel) """
+    png_file = png.Png(path)
+    hdr = png_file.get_ihdr_chunk().get_hdr_data()
+    data = zlib.decompress(
+        b''.join(i.get_chunk() for i in png_file.get_all_idat_chunks()))
+    bits_per_pixel = CHANNELS_BY_COLOR_TYPE[hdr.color_type] * hdr.bit_depth
+    stride = (hdr.width * bits_per_pixel + 7) // 8
+    return path, data, hdr.height, stride, max(1, bits_per_pixel // 8)
+
+
+def synthetic_scanlines(width: int, height: int, bytes_per_pixel: int, filter_types) -> tuple:
+    """ Returns random scanlines in the same format as picture_scanlines """
+    rng = np.random.default_rng(0)
+    stride = width * bytes_per_pixel
+    data = rng.integers(0, 256, (height, stride + 1), dtype=np.uint8)
+    data[:, 0] = rng.choice(filter_types, height)
+    name = f"synthetic {width}x{height}x{bytes_per_pixel} filters {filter_types}"
+    return name, data.tobytes(), height, stride, bytes_per_pixel
+
+
+def write_synthetic_png(file_name: str, width: int, height: int, color_type: int = 6,
+                        bit_depth: int = 8, idat_size: int = 1 << 20, level: int = 1,
+                        filter_types=(0,)):
+    """ Writes a random image (scanline filter types drawn from filter_types), returns its path """
+    rng = np.random.default_rng(0)
+    stride = (width * CHANNELS_BY_COLOR_TYPE[color_type] * bit_depth + 7) // 8
+    scanlines = rng.integers(0, 256, (height, stride + 1), dtype=np.uint8)
+    scanlines[:, 0] = rng.choice(filter_types, height)
+    compressed = zlib.compress(scanlines.tobytes(), level)
+
+    def write_chunk(f, chunk_type: bytes, data: bytes):
+        f.write(struct.pack('>I', len(data)))
+        f.write(chunk_type)
+        f.write(data)
+        f.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type))))
+
+    with open(file_name, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        write_chunk(f, b'IHDR', struct.pack('>IIBBBBB', width, height,
+                                            bit_depth, color_type, 0, 0, 0))
+        if color_type == 3:
+            write_chunk(f, b'PLTE', rng.integers(
+                0, 256, 3 * 2 ** bit_depth, dtype=np.uint8).tobytes())
+        for i in range(0, len(compressed), idat_size):
+            write_chunk(f, b'IDAT', compressed[i:i + idat_size])
+        write_chunk(f, b'IEND', b'')
+    return file_name
+
+
+def bench_unfilter(args):
+    cases = [picture_scanlines(path) for path in sorted(glob.glob(PICTURES_GLOB))]
+    for width, height in SYNTHETIC_SIZES:
+        cases.append(synthetic_scanlines(width, height, 4, [0, 1, 2]))
+        cases.append(synthetic_scanlines(width, height, 4, [0, 1, 2, 3, 4]))
+        # what adaptive encoders mostly write: Paeth with some Sub and Up rows
+        cases.append(synthetic_scanlines(width, height, 4, [1, 2, 4, 4, 4, 4]))
+        cases.append(synthetic_scanlines(width, height, 3, [4]))
+    # lone Average/Paeth rows, one wavefront step per pixel
+    for width, _ in SYNTHETIC_SIZES:
+        cases.append(synthetic_scanlines(width, 1, 4, [3]))
+        cases.append(synthetic_scanlines(width, 1, 4, [4]))
+
+    print(f"{'case':60} {'MB':>8} {'numpy s':>10} {'MB/s':>9} {'legacy s':>10} {'speedup':>8}")
+    for name, data, height, stride, bpp in cases:
+        megabytes = height * stride / 1e6
+        new_time, result = timed(
+            filters.unfilter_scanlines, data, height, stride, bpp, repeat=args.repeat)
+        line = f"{name:60} {megabytes:8.2f} {new_time:10.4f} {megabytes / new_time:9.1f}"
+        if height * stride <= args.legacy_max_bytes:
+            legacy_time, legacy_result = timed(
+                legacy_defilter, data, height, stride, bpp)
+            assert legacy_result == result.tobytes(), f"Mismatch on {name}"
+            line += f" {legacy_time:10.4f} {legacy_time / new_time:8.1f}"
+        else:
+            line += f" {'skipped':>10}"
+        print(line)
+
+
+def bench_crc(args):
+    paths = sorted(glob.glob(PICTURES_GLOB))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for width, height in SYNTHETIC_SIZES:
+            paths.append(write_synthetic_png(
+                os.path.join(tmp_dir, f"synthetic_{width}x{height}.png"), width, height))
+        modes = [chunk.CRC_OFF, chunk.CRC_LAZY, chunk.CRC_STRICT]
+        print(f"{'file':40} {'MB':>8}" + ''.join(f" {'parse ' + m:>13} {'decode ' + m:>14}" for m in modes))
+        for path in paths:
+            line = f"{os.path.basename(path):40} {os.path.getsize(path) / 1e6:8.2f}"
+            for mode in modes:
+                # parse only, then parse and touch all of the image data
+                parse_time, _ = timed(
+                    png.Png, path, False, False, mode, repeat=args.repeat)
+                decode_time, _ = timed(lambda: [band for band in png.Png(
+                    path, crc_mode=mode).iter_scanlines(band_rows=256)], repeat=args.repeat)
+                line += f" {parse_time:13.4f} {decode_time:14.4f}"
+            print(line)
+
+
+def bench_memory(args):
+    """ Bytes allocated per parsed file while many parsed files are kept alive,
+        mmapped pages are not allocations and do not show up here
+    """
+    modes = {"full": {}, "lazy": {"lazy": True}, "mmap": {"use_mmap": True}}
+    print(f"{'file':40} {'file KB':>9}" + ''.join(f" {m + ' B/file':>14}" for m in modes))
+    for path in sorted(glob.glob(PICTURES_GLOB)):
+        line = f"{os.path.basename(path):40} {os.path.getsize(path) / 1e3:9.1f}"
+        for kwargs in modes.values():
+            gc.collect()
+            tracemalloc.start()
+            parsed = [png.Png(path, **kwargs) for _ in range(args.copies)]
+            used, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del parsed
+            line += f" {used / args.copies:14.0f}"
+        print(line)
+
+
+def bench_stream_memory(args):
+    """ Peak traced memory of opening and encrypting (AES-CTR) RGB images of
+        growing size, bounded by png.STREAM_BAND_BYTES rather than the image
+    """
+    public_key, private_key = generate_keypair()
+    print(f"{'megapixels':>10} {'file MB':>9} {'open MB':>9} {'peak MB':>9} {'seconds':>9}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for megapixels in args.megapixels:
+            side = int(math.sqrt(megapixels * 1e6))
+            path = write_synthetic_png(os.path.join(tmp_dir, "source.png"), side, side, color_type=2,
+                                       filter_types=(0, 1, 2, 4))
+            gc.collect()
+            tracemalloc.start()
+            start = time.perf_counter()
+            encrypted = png.EncryptedPng(path, public_key=public_key, private_key=private_key)
+            opened, _ = tracemalloc.get_traced_memory()
+            encrypted.encrypt_aes_ctr(os.path.join(tmp_dir, "encrypted.png"))
+            seconds = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            encrypted.close()
+            print(f"{megapixels:10.1f} {os.path.getsize(path) / 1e6:9.1f} {opened / 1e6:9.2f} "
+                  f"{peak / 1e6:9.1f} {seconds:9.2f}")
+
+
+def bench_rsa(args):
+    public_key, private_key = generate_keypair()
+    rsa = rsa2048([], public_key=public_key, private_key=private_key)
+    # whole ECB blocks, a trailing partial block does not survive the round trip
+    sample = os.urandom(args.blocks * rsa.ENCRYPT_BLOCK_SIZE_SUBTRACT)
+    _, (_, extra_bytes) = timed(rsa.encrypt_all_data_ECB, sample, 1)
+    ciphertext = bytes(rsa.get_encrypted_pixels())
+    print(f"{'private key':20} {'MB':>8} {'seconds':>10} {'MB/s':>9} {'speedup':>8}")
+    baseline = None
+    for name, key in [("(n, d)", private_key[:2]), ("CRT", private_key)]:
+        rsa.private_key = key
+        seconds, decrypted = timed(rsa.decrypt_all_data_ECB, ciphertext, extra_bytes, 1, repeat=args.repeat)
+        assert decrypted == sample
+        baseline = baseline or seconds
+        print(f"{name:20} {len(sample) / 1e6:8.3f} {seconds:10.4f} {len(sample) / 1e6 / seconds:9.3f} "
+              f"{baseline / seconds:8.2f}")
+
+
+def encode_with_strategy(scanlines: np.ndarray, png_file: png.Png, strategy: str, level: int) -> int:
+    """ Returns the size of the PNG file written with a filter strategy """
+    output = io.BytesIO()
+    with PngEncoder(output, png_file.get_width(), png_file.get_height(), png_file.get_bit_depth(),
+                    png_file.get_color_type(), level=level, filter_strategy=strategy) as encoder:
+        encoder.write_rows(scanlines)
+        encoder.finish()
+    return output.tell()
+
+
+def bench_filters(args):
+    """ Written file size and encode time of every filter strategy """
+    strategies = list(filters.FILTER_STRATEGIES)
+    print(f"{'file':40} {'file KB':>9}" + ''.join(f" {s + ' KB':>12} {'s':>7}" for s in strategies))
+    for path in sorted(glob.glob(PICTURES_GLOB)):
+        png_file = png.Png(path)
+        scanlines = png_file.decode_scanlines()
+        line = f"{os.path.basename(path):40} {os.path.getsize(path) / 1e3:9.1f}"
+        for strategy in strategies:
+            seconds, size = timed(encode_with_strategy, scanlines, png_file, strategy, args.level,
+                                  repeat=args.repeat)
+            line += f" {size / 1e3:12.1f} {seconds:7.3f}"
+        print(line)
+
+
+def bench_deflate(args):
+    """ Encode time of a synthetic RGBA image by compression threads """
+    rng = np.random.default_rng(0)
+    side = int(math.sqrt(args.megapixels * 1e6))
+    # gradient with some noise
+    image = ((np.arange(side)[:, None, None] + np.arange(side)[None, :, None]) // 8
+             + rng.integers(0, 4, (side, side, 4))).astype(np.uint8)
+    scanlines = image.reshape(side, side * 4)
+    print(f"{'threads':>8} {'MB':>8} {'seconds':>10} {'MB/s':>9} {'speedup':>8} {'size KB':>10}")
+    baseline = None
+    for threads in args.threads:
+        def encode():
+            output = io.BytesIO()
+            with PngEncoder(output, side, side, 8, 6, level=args.level, threads=threads) as encoder:
+                encoder.write_rows(scanlines)
+                encoder.finish()
+            return output.tell()
+        seconds, size = timed(encode, repeat=args.repeat)
+        baseline = baseline or seconds
+        print(f"{threads:8d} {scanlines.nbytes / 1e6:8.1f} {seconds:10.4f} {scanlines.nbytes / 1e6 / seconds:9.2f} "
+              f"{baseline / seconds:8.2f} {size / 1e3:10.1f}")
+
+
+def bench_pipeline(args):
+    """ decode_scanlines time, serial vs inflate and unfilter overlapped on two
+        threads (iter_scanlines_pipelined). The pipeline is timed even where
+        decode_scanlines(pipelined=True) falls back to serial decoding (the
+        "used" column, see Png.pipeline_pays): it can only help with a second
+        CPU and images of several bands, at best hiding the shorter stage
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = [path for path in sorted(glob.glob(PICTURES_GLOB)) if os.path.getsize(path) > 100_000]
+        for width, height in SYNTHETIC_SIZES:
+            paths.append(write_synthetic_png(os.path.join(tmp_dir, f"synthetic_{width}x{height}.png"),
+                                             width, height, filter_types=(0, 1, 2, 4)))
+        print(f"{'file':40} {'MB':>8} {'serial s':>10} {'pipelined s':>12} {'speedup':>8} {'used':>5}")
+        for path in paths:
+            png_file = png.Png(path)
+            if png_file.get_interlace_method() != 0:
+                continue
+            band_rows = max(1, png.PIPELINE_BAND_BYTES // png_file.get_stride())
+            serial_time, serial = timed(png_file.decode_scanlines, False, repeat=args.repeat)
+            pipelined_time, pipelined = timed(
+                lambda: np.concatenate(list(png_file.iter_scanlines_pipelined(band_rows))), repeat=args.repeat)
+            assert np.array_equal(serial, pipelined), f"Mismatch on {path}"
+            print(f"{os.path.basename(path):40} {serial.nbytes / 1e6:8.2f} {serial_time:10.4f} "
+                  f"{pipelined_time:12.4f} {serial_time / pipelined_time:8.2f} "
+                  f"{str(png_file.pipeline_pays(band_rows)):>5}")
+
+
+def read_chunks_again(png_file: png.Png):
+    """ Png.read_chunks on an already parsed file """
+    png_file.chunks = []
+    png_file.chunk_index = {}
+    with png_file.open_file() as file_png:
+        png_file.read_signature(file_png)
+        png_file.read_chunks(file_png)
+
+
+def suite_cases(megapixels: list, tmp_dir: str):
+    """ Yields (case name, path) for the pictures and one synthetic image per
+        size and colour type, all scanline filter types mixed
+    """
+    for path in sorted(glob.glob(PICTURES_GLOB)):
+        yield os.path.basename(path), path
+    for size in megapixels:
+        side = int(math.sqrt(size * 1e6))
+        for color_type in SUITE_COLOR_TYPES:
+            name = f"synthetic {size}MP color type {color_type}"
+            path = write_synthetic_png(os.path.join(tmp_dir, f"{size}mp_{color_type}.png"),
+                                       side, side, color_type, filter_types=range(5))
+            yield name, path
+            os.remove(path)
+
+
+def bench_file(path: str, keys: tuple, tmp_dir: str, args) -> list:
+    """ Returns (stage, best seconds, bytes processed) for every stage """
+    results = []
+    size = os.path.getsize(path)
+    seconds, png_file = timed(png.Png, path, repeat=args.repeat)
+    results.append(("Png.__init__", seconds, size))
+    seconds, _ = timed(read_chunks_again, png_file, repeat=args.repeat)
+    results.append(("Png.read_chunks", seconds, size))
+    seconds, _ = timed(png.AnomizedPng, path, repeat=args.repeat)
+    results.append(("AnomizedPng", seconds, size))
+
+    encrypted = png.EncryptedPng(path, public_key=keys[0], private_key=keys[1])
+    if encrypted.get_interlace_method() != 0:
+        return results
+    data = zlib.decompress(
+        b''.join(i.get_chunk() for i in encrypted.get_all_idat_chunks()))
+    seconds, pixels = timed(encrypted.defilter_data, data, repeat=args.repeat)
+    results.append(("EncryptedPng.defilter_data", seconds, len(data)))
+    seconds, _ = timed(encrypted.build_png_from_chunks, os.path.join(tmp_dir, "built.png"),
+                       pixels, b'', repeat=args.repeat)
+    results.append(("EncryptedPng.build_png_from_chunks", seconds, len(pixels)))
+
+    # the RSA modes are far slower than everything else, they only get a
+    # prefix of the pixels (the same for every run), in whole ECB blocks as
+    # a trailing partial block does not survive the ECB round trip
+    rsa = encrypted.rsa_2048
+    block = rsa.ENCRYPT_BLOCK_SIZE_SUBTRACT
+    sample = pixels[:max(block, args.crypto_bytes // block * block)]
+    seconds, (_, extra_bytes) = timed(rsa.encrypt_all_data_ECB, sample)
+    results.append(("rsa2048.encrypt_all_data_ECB", seconds, len(sample)))
+    ciphertext = bytes(rsa.get_encrypted_pixels())
+    seconds, _ = timed(rsa.decrypt_all_data_ECB, ciphertext, extra_bytes)
+    results.append(("rsa2048.decrypt_all_data_ECB", seconds, len(sample)))
+    seconds, (iv, ciphertext) = timed(rsa.encrypt_all_data_CFB, sample)
+    results.append(("rsa2048.encrypt_all_data_CFB", seconds, len(sample)))
+    seconds, _ = timed(rsa.decrypt_all_data_CFB, bytes(ciphertext), iv)
+    results.append(("rsa2048.decrypt_all_data_CFB", seconds, len(sample)))
+    seconds, _ = timed(rsa.encrypt_all_data_AES_ECB, sample, keys[0])
+    results.append(("rsa2048.encrypt_all_data_AES_ECB", seconds, len(sample)))
+    # the hybrid mode is fast enough for all of the pixels
+    seconds, (extra_bytes, ciphertext) = timed(rsa.encrypt_all_data_AES_CTR, pixels, repeat=args.repeat)
+    results.append(("rsa2048.encrypt_all_data_AES_CTR", seconds, len(pixels)))
+    seconds, _ = timed(rsa.decrypt_all_data_AES_CTR, ciphertext, extra_bytes, repeat=args.repeat)
+    results.append(("rsa2048.decrypt_all_data_AES_CTR", seconds, len(pixels)))
+    encrypted.close()
+    return results
+
+
+def bench_suite(args):
+    records = []
+
+    def record(case: str, stage: str, seconds: float, processed: int):
+        records.append({"case": case, "stage": stage, "seconds": seconds, "bytes": processed,
+                        "mb_per_s": processed / 1e6 / seconds if seconds > 0 else None})
+        print(f"{case:40} {stage:40} {seconds:10.4f} {processed / 1e6:9.2f}", flush=True)
+
+    print(f"{'case':40} {'stage':40} {'seconds':>10} {'MB':>9}")
+    # the library prints progress while it works, keep it out of the table
+    with open(os.devnull, 'w') as devnull, tempfile.TemporaryDirectory() as tmp_dir:
+        with contextlib.redirect_stdout(devnull):
+            seconds, rsa = timed(rsa2048, [])
+        record("-", "rsa2048 key generation", seconds, 0)
+        keys = (rsa.get_public_key(), rsa.get_private_key())
+        for case, path in suite_cases(args.megapixels, tmp_dir):
+            with contextlib.redirect_stdout(devnull):
+                results = bench_file(path, keys, tmp_dir, args)
+            for stage, seconds, processed in results:
+                record(case, stage, seconds, processed)
+
+    report = {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "repeat": args.repeat,
+            "crypto_bytes": args.crypto_bytes,
+            "megapixels": args.megapixels,
+        },
+        "results": records,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print(f"Results written to {args.output}")
+
+
+def bench_compare(args):
+    """ Exits with status 1 if any stage got slower than the threshold allows """
+    with open(args.baseline) as f:
+        baseline = {(r["case"], r["stage"]): r["seconds"] for r in json.load(f)["results"]}
+    with open(args.candidate) as f:
+        candidate = json.load(f)["results"]
+
+    regressions = 0
+    print(f"{'case':40} {'stage':40} {'baseline s':>11} {'new s':>10} {'ratio':>7}")
+    for result in candidate:
+        key = (result["case"], result["stage"])
+        if key not in baseline:
+            print(f"{key[0]:40} {key[1]:40} {'-':>11} {result['seconds']:10.4f} {'new':>7}")
+            continue
+        old, new = baseline[key], result["seconds"]
+        ratio = new / old if old > 0 else float('inf')
+        status = ""
+        if max(old, new) >= args.min_seconds:
+            if ratio > 1 + args.threshold:
+                status = "REGRESSION"
+                regressions += 1
+            elif ratio < 1 - args.threshold:
+                status = "faster"
+        print(f"{key[0]:40} {key[1]:40} {old:11.4f} {new:10.4f} {ratio:7.2f} {status}")
+    print(f"{regressions} regressions (threshold {args.threshold:.0%})")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    log.basicConfig(
+        format='%(levelname)s {%(pathname)s:%(lineno)d} %(asctime)s %(message)s', level=log.ERROR)
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    unfilter_parser = subparsers.add_parser(
+        'unfilter', help='scanline reconstruction, numpy engine vs legacy loop')
+    unfilter_parser.add_argument('--repeat', type=int, default=3)
+    unfilter_parser.add_argument('--legacy-max-bytes', type=int, default=200_000,
+                                 help='skip the (quadratic) legacy loop above this image size')
+    unfilter_parser.set_defaults(function=bench_unfilter)
+
+    crc_parser = subparsers.add_parser(
+        'crc', help='parse and decode time for every CRC mode')
+    crc_parser.add_argument('--repeat', type=int, default=3)
+    crc_parser.set_defaults(function=bench_crc)
+
+    memory_parser = subparsers.add_parser(
+        'memory', help='memory kept per parsed file for every parse mode')
+    memory_parser.add_argument('--copies', type=int, default=200,
+                               help='parsed copies of every file kept alive at once')
+    memory_parser.set_defaults(function=bench_memory)
+
+    stream_memory_parser = subparsers.add_parser(
+        'stream-memory', help='peak memory of AES-CTR encryption by image size')
+    stream_memory_parser.add_argument('--megapixels', type=float, nargs='+', default=[4, 9, 16],
+                                      help='sizes of the synthetic RGB images')
+    stream_memory_parser.set_defaults(function=bench_stream_memory)
+
+    rsa_parser = subparsers.add_parser(
+        'rsa', help='RSA-ECB decryption throughput, (n, d) vs CRT private key (one process)')
+    rsa_parser.add_argument('--blocks', type=int, default=64, help='255-byte blocks decrypted')
+    rsa_parser.add_argument('--repeat', type=int, default=3)
+    rsa_parser.set_defaults(function=bench_rsa)
+
+    filters_parser = subparsers.add_parser(
+        'filters', help='written size and encode time of every filter strategy')
+    filters_parser.add_argument('--level', type=int, default=zlib.Z_DEFAULT_COMPRESSION, help='zlib level')
+    filters_parser.add_argument('--repeat', type=int, default=1)
+    filters_parser.set_defaults(function=bench_filters)
+
+    deflate_parser = subparsers.add_parser(
+        'deflate', help='PNG encode time by zlib compression threads')
+    deflate_parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4])
+    deflate_parser.add_argument('--megapixels', type=float, default=4)
+    deflate_parser.add_argument('--level', type=int, default=zlib.Z_DEFAULT_COMPRESSION, help='zlib level')
+    deflate_parser.add_argument('--repeat', type=int, default=3)
+    deflate_parser.set_defaults(function=bench_deflate)
+
+    pipeline_parser = subparsers.add_parser(
+        'pipeline', help='decode time, serial vs pipelined inflate and unfilter')
+    pipeline_parser.add_argument('--repeat', type=int, default=3)
+    pipeline_parser.set_defaults(function=bench_pipeline)
+
+    suite_parser = subparsers.add_parser(
+        'suite', help='parse, decode, encrypt and write stages, results to JSON')
+    suite_parser.add_argument('-o', '--output', default='benchmark.json')
+    suite_parser.add_argument('--repeat', type=int, default=3)
+    suite_parser.add_argument('--megapixels', type=float, nargs='+', default=SUITE_MEGAPIXELS,
+                              help='sizes of the synthetic images')
+    suite_parser.add_argument('--crypto-bytes', type=int, default=16384,
+                              help='pixel bytes given to each rsa2048 mode')
+    suite_parser.set_defaults(function=bench_suite)
+
+    compare_parser = subparsers.add_parser(
+        'compare', help='flag stages of a suite run slower than in a baseline run')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                                help='allowed relative slowdown')
+    compare_parser.add_argument('--min-seconds', type=float, default=REGRESSION_MIN_SECONDS,
+                                help='ignore stages faster than this in both runs')
+    compare_parser.set_defaults(function=bench_compare)
+
+    args = parser.parse_args()
+    args.function(args)
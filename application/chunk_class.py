@@ -4,7 +4,17 @@ several "special" chunks
 """
 import logging as log
 import zlib
-from typing import List, Dict, Tuple, Union
+import numpy as np
+from typing import List, Dict, NamedTuple, Tuple, Union
+
+# CRC handling modes:
+# - strict: every CRC is verified while the file is parsed
+# - lazy: a CRC is verified the first time the chunk data is accessed
+# - off: CRCs are not verified at all (trusted input)
+CRC_STRICT = 'strict'
+CRC_LAZY = 'lazy'
+CRC_OFF = 'off'
+
 
 class Chunk:
     """
@@ -13,99 +23,234 @@ class Chunk:
     - 4 bytes: Type of chunk, i.e. IHDR, PLTE, IDAT
     - Length bytes: Chunk data
     - 4 bytes: CRC32
+    Chunks are created by from_file, from_index or from_buffer, which pick
+    the class matching the chunk type (see CHUNK_CLASSES). All classes use
+    __slots__, as a parsed file can keep many thousands of chunks around
     """
     LENGTH_FIELD_LEN = 4
     TYPE_FIELD_LEN = 4
     CRC_FIELD_LEN = 4
 
-    def __init__(self, file_ptr) -> None:
+    __slots__ = ('offset', 'chunk_length', 'chunk_type', 'chunk_data', 'crc32_value',
+                 'crc_mode', 'source', 'data_offset', 'unverified_data')
+
+    @classmethod
+    def create(cls, header: bytes, offset: int) -> 'Chunk':
+        """
+        Returns a chunk without data or CRC from its length and type fields,
+        of the class matching its type
         """
-        Initiates and reads all values for the class:
+        chunk_type = bytes(header[cls.LENGTH_FIELD_LEN:]).decode('ascii')
+        self = object.__new__(CHUNK_CLASSES.get(chunk_type, Chunk))
+        self.offset = offset
+        self.chunk_length = int.from_bytes(
+            header[:cls.LENGTH_FIELD_LEN], 'big', signed=False)
+        self.chunk_type = chunk_type
+        self.crc_mode = CRC_OFF
+        self.source = None
+        self.data_offset = None
+        self.unverified_data = None
+        log.debug("Chunk type: %s, length: %d", self.chunk_type, self.chunk_length)
+        return self
+
+    @classmethod
+    def from_file(cls, file_ptr, crc_mode: str = CRC_OFF) -> 'Chunk':
+        """
+        Reads the whole chunk at the current file position:
         - Chunk length (int)
         - Chunk type (str)
         - Chunk data (bytes)
         - Chunk crc32 (int)
         """
-        self.file_ptr = file_ptr
-
-        self.read_length()
-        self.read_chunk_type()
-        self.read_data()
-        self.read_crc32()
-        if (self.chunk_type == 'IHDR'):
-            self.__class__ = IHDR
-        elif (self.chunk_type == 'IDAT'):
-            self.__class__ = IDAT
-        elif (self.chunk_type == 'PLTE'):
-            self.__class__ = PLTE
-        elif (self.chunk_type == 'IEND'):
-            self.__class__ = IEND
-        elif (self.chunk_type == 'gAMA'):
-            self.__class__ = gAMA
-        elif (self.chunk_type == 'cHRM'):
-            self.__class__ = cHRM
-        elif (self.chunk_type == 'sRGB'):
-            self.__class__ = sRGB
-        elif (self.chunk_type == 'eXIf'):
-            self.__class__ = eXIf
-        elif (self.chunk_type == 'bKGD'):
-            self.__class__ = bKGD
-        elif (self.chunk_type == 'hIST'):
-            self.__class__ = hIST
-
-    def read_length(self):
-        """
-        Gets the length of Chunk - first 4 bytes of chunk
-        self.chunk_length is an int created from big-endian representation of
-        consecutive bytes
-        """
-
-        self.raw_length = self.file_ptr.read(self.LENGTH_FIELD_LEN)
-
-        # log.debug(length)
-        self.chunk_length = int.from_bytes(
-            self.raw_length, 'big', signed=False)
-        log.debug("Chunk length: %d", self.chunk_length)
+        offset = file_ptr.tell()
+        self = cls.create(file_ptr.read(
+            cls.LENGTH_FIELD_LEN + cls.TYPE_FIELD_LEN), offset)
+        self.read_data(file_ptr)
+        self.read_crc32(file_ptr)
+        self.set_crc_mode(crc_mode)
+        return self
+
+    @classmethod
+    def from_index(cls, file_ptr, crc_mode: str = CRC_OFF, deferred_types: Tuple[str, ...] = None) -> 'Chunk':
+        """
+        Reads only the length and type of the chunk at the current file
+        position and seeks past the rest of it. The data and CRC are read
+        the first time they are accessed (see __getattr__), from the file
+        reopened by name - the chunk keeps no file handle
+        With deferred_types only chunks of these types are deferred, the
+        others are read whole like with from_file
+        """
+        offset = file_ptr.tell()
+        self = cls.create(file_ptr.read(
+            cls.LENGTH_FIELD_LEN + cls.TYPE_FIELD_LEN), offset)
+        if deferred_types is not None and self.chunk_type not in deferred_types:
+            self.read_data(file_ptr)
+            self.read_crc32(file_ptr)
+            self.set_crc_mode(crc_mode)
+            return self
+        self.source = file_ptr.name
+        self.data_offset = file_ptr.tell()
+        self.crc_mode = crc_mode
+        if crc_mode == CRC_STRICT:
+            self.load_data(file_ptr)
+        file_ptr.seek(self.data_offset + self.chunk_length + cls.CRC_FIELD_LEN)
+        return self
+
+    @classmethod
+    def from_buffer(cls, buffer: memoryview, offset: int = 0, crc_mode: str = CRC_OFF) -> 'Chunk':
+        """
+        Creates the chunk starting at offset in buffer (i.e. a memoryview of
+        a mmapped file) without copying its payload - chunk_data is a
+        memoryview slice of buffer
+        """
+        data_start = offset + cls.LENGTH_FIELD_LEN + cls.TYPE_FIELD_LEN
+        self = cls.create(buffer[offset:data_start], offset)
+        data_end = data_start + self.chunk_length
+        self.chunk_data = buffer[data_start:data_end]
+        self.crc32_value = int.from_bytes(
+            buffer[data_end:data_end + cls.CRC_FIELD_LEN], 'big')
+        self.set_crc_mode(crc_mode)
+        return self
+
+    def set_crc_mode(self, crc_mode: str):
+        """
+        Verifies the CRC now (strict), hides the data until it is first
+        accessed and verified (lazy) or does nothing (off)
+        """
+        self.crc_mode = crc_mode
+        if crc_mode == CRC_STRICT:
+            self.check_crc()
+        elif crc_mode == CRC_LAZY:
+            self.unverified_data = self.chunk_data
+            del self.chunk_data
+
+    def __getattr__(self, name: str):
+        """
+        Only called for slots which are not set yet: verifies the data of
+        lazily checked chunks, and loads the data and CRC of chunks created
+        with from_index, on first access
+        """
+        if name not in ('chunk_data', 'crc32_value'):
+            raise AttributeError(name)
+        if name == 'chunk_data' and self.unverified_data is not None:
+            self.chunk_data = self.unverified_data
+            self.unverified_data = None
+            self.check_crc()
+            return self.chunk_data
+        if self.data_offset is not None:
+            self.load_data()
+            return object.__getattribute__(self, name)
+        raise AttributeError(name)
+
+    def load_data(self, file_ptr=None):
+        """
+        Reads (and unless CRCs are off, verifies) the data and CRC of a chunk
+        created with from_index, reopening its file unless file_ptr is given
+        """
+        if file_ptr is None:
+            with open(self.source, 'rb') as file_ptr:
+                return self.load_data(file_ptr)
+        file_ptr.seek(self.data_offset)
+        self.read_data(file_ptr)
+        self.read_crc32(file_ptr)
+        if self.crc_mode != CRC_OFF:
+            self.check_crc()
+
+    def read_payload(self, file_ptr=None) -> bytes:
+        """
+        Returns the chunk data like get_chunk, but the data of a chunk created
+        with from_index (and not accessed yet) is read from file_ptr (or the
+        file reopened by name) and verified without being kept on the chunk,
+        so streaming over many chunks holds one payload at a time
+        """
+        try:
+            return object.__getattribute__(self, 'chunk_data')
+        except AttributeError:
+            pass
+        if self.data_offset is None or self.unverified_data is not None:
+            return self.chunk_data
+        if file_ptr is None:
+            with open(self.source, 'rb') as file_ptr:
+                return self.read_payload(file_ptr)
+        file_ptr.seek(self.data_offset)
+        data = file_ptr.read(self.chunk_length)
+        crc32_value = int.from_bytes(file_ptr.read(self.CRC_FIELD_LEN), 'big')
+        if self.crc_mode != CRC_OFF and zlib.crc32(data, zlib.crc32(self.chunk_type.encode('ascii'))) != crc32_value:
+            log.error("CRC mismatch in %s chunk at offset %d", self.chunk_type, self.offset)
+            raise Exception("CRC error")
+        return data
+
+    def calculate_crc(self) -> int:
+        """
+        CRC32 of the chunk type and data, computed incrementally so the two
+        are never concatenated
+        """
+        return zlib.crc32(self.chunk_data, zlib.crc32(self.chunk_type.encode('ascii')))
+
+    def check_crc(self) -> bool:
+        """
+        Raises an exception if the stored CRC does not match the chunk
+        """
+        if self.calculate_crc() != self.crc32_value:
+            log.error("CRC mismatch in %s chunk at offset %d",
+                      self.chunk_type, self.offset)
+            raise Exception("CRC error")
+        return True
 
-    def read_chunk_type(self):
+    def update_crc(self) -> bool:
         """
-        Gets the type of chunk - str of 4 letters after chunk_length
-        self.chunk_type is the decoding of the second 4 bytes to ascii
+        Recomputes the CRC after the chunk data has changed
+        Returns True if the stored CRC was different
         """
-        chunk_type = b''
+        crc32_value = self.calculate_crc()
+        changed = crc32_value != self.crc32_value
+        self.crc32_value = crc32_value
+        return changed
 
-        chunk_type = self.file_ptr.read(self.TYPE_FIELD_LEN)
-        # log.debug(chunk_type)
-        self.chunk_type = chunk_type.decode('ascii')
-        log.debug("Chunk type: %s", self.chunk_type)
-
-    def read_data(self):
+    def read_data(self, file_ptr):
         """
         Gets the data (chunk_length bytes after chunk_type), and stores
         it in the self.chunk_data list
         """
-        data = self.file_ptr.read(self.chunk_length)
-        self.chunk_data = data
-        log.debug("Chunk data: %s", data)
+        self.chunk_data = file_ptr.read(self.chunk_length)
+        log.debug("Chunk data: %d bytes", len(self.chunk_data))
 
-    def read_crc32(self):
+    def read_crc32(self, file_ptr):
         """
         Gets the last 4 bytes of the chunk, which is the crc32
         self.crc32_value is the unsigned int as big endian 
         representation of the last 4 bytes
         """
-        self.crc32 = self.file_ptr.read(self.CRC_FIELD_LEN)
-
-        # log.debug(crc32)
-        self.crc32_value = int.from_bytes(self.crc32, 'big')
+        self.crc32_value = int.from_bytes(
+            file_ptr.read(self.CRC_FIELD_LEN), 'big')
         log.debug("Chunk crc32: %d", self.crc32_value)
 
+    @property
+    def raw_length(self) -> bytes:
+        """
+        The length field as stored in the file
+        """
+        return self.chunk_length.to_bytes(self.LENGTH_FIELD_LEN, 'big')
+
+    @property
+    def crc32(self) -> bytes:
+        """
+        The CRC field as stored in the file
+        """
+        return self.crc32_value.to_bytes(self.CRC_FIELD_LEN, 'big')
+
     def get_length(self) -> int:
         """
         Get chunk length :D
         """
         return self.chunk_length
 
+    def get_offset(self) -> int:
+        """
+        Get offset of the chunk in the file
+        """
+        return self.offset
+
     def get_chunk_type(self) -> str:
         """
         Get chunk type :D
@@ -123,7 +268,14 @@ class Chunk:
         """
         Returns all chunk data as bytes
         """
-        return self.raw_length + self.chunk_type.encode('ascii') + self.chunk_data + self.crc32_value.to_bytes(self.CRC_FIELD_LEN, 'big')
+        return b''.join(self.to_pieces())
+
+    def to_pieces(self) -> list:
+        """
+        Returns the chunk as [length and type, data, CRC], for writelines or
+        os.writev, the data is not copied
+        """
+        return [self.raw_length + self.chunk_type.encode('ascii'), self.chunk_data, self.crc32]
 
     def get_chunk_size(self) -> int:
         """
@@ -137,17 +289,17 @@ class Chunk:
         """
         if len(new_crc) != self.CRC_FIELD_LEN:
             return False
-        self.crc32 = new_crc
+        self.crc32_value = int.from_bytes(new_crc, 'big')
         return True
 
     def replace_chunk_data(self, new_data: bytes) -> bool:
         """
-        Replaces the current chunk data with a new one
+        Replaces the current chunk data with a new one (and updates the CRC)
         """
+        self.unverified_data = None
         self.chunk_data = new_data
         self.chunk_length = len(new_data)
-        self.raw_length = self.chunk_length.to_bytes(
-            self.LENGTH_FIELD_LEN, 'big')
+        self.update_crc()
         return True
     
     def assert_chunk(self) -> bool:
@@ -172,41 +324,54 @@ class Chunk:
 
 
 class IDAT(Chunk):
+    """
+    The sections above are slices of chunk_data taken on access, so they
+    are never stored next to it
+    """
+    __slots__ = ()
+
+    @property
+    def zlib_header(self):
+        return self.chunk_data[0:2]
+
+    @property
+    def bfinal_btype(self):
+        return self.chunk_data[2:3]
 
-    def __init__(self, file_ptr) -> None:
-        pass
+    @property
+    def len_nlen(self):
+        return self.chunk_data[3:7]
 
-    def divide_chunk_into_sections(self):
-        self.zlib_header = self.chunk_data[0:2]
-        # print(self.zlib_header)
-        self.bfinal_btype = self.chunk_data[2:3]
-        self.len_nlen = self.chunk_data[3:7]
-        # print(self.len_nlen)
-        self.filter = self.chunk_data[7:8]
-        self.idat_data = self.chunk_data[8:-4]
-        self.adler32 = self.chunk_data[-4:]
+    @property
+    def filter(self):
+        return self.chunk_data[7:8]
+
+    @property
+    def idat_data(self):
+        return self.chunk_data[8:-4]
+
+    @property
+    def adler32(self):
+        return self.chunk_data[-4:]
 
     def get_idat_data(self):
         # print(len(self.idat_data))
         return self.idat_data
 
     def update_adler32(self):
-        self.adler32 = zlib.adler32(self.idat_data).to_bytes(4, 'big')
-        self.chunk_data = self.zlib_header + self.bfinal_btype + \
-            self.len_nlen + self.filter + self.idat_data + self.adler32
+        adler32 = zlib.adler32(self.idat_data).to_bytes(4, 'big')
+        self.replace_chunk_data(b''.join((self.chunk_data[:-4], adler32)))
 
     def replace_idat_data(self, new_idat_data: bytes):
-        self.idat_data = new_idat_data
         # self.update_adler32()
-        self.chunk_data = self.zlib_header + self.bfinal_btype + \
-            self.len_nlen + self.filter + self.idat_data + self.adler32
+        self.replace_chunk_data(b''.join(
+            (self.chunk_data[:8], new_idat_data, self.chunk_data[-4:])))
 
     def update_len_and_nlen(self, new_length: int):
         negated = (~new_length) & 0xFF
-        self.len_nlen = new_length.to_bytes(
-            2, 'big') + negated.to_bytes(2, 'big')
-        self.chunk_data = self.zlib_header + self.bfinal_btype + \
-            self.len_nlen + self.filter + self.idat_data + self.adler32
+        len_nlen = new_length.to_bytes(2, 'big') + negated.to_bytes(2, 'big')
+        self.replace_chunk_data(b''.join(
+            (self.chunk_data[:3], len_nlen, self.chunk_data[7:])))
         
     def assert_chunk(self) -> bool:
         """
@@ -215,69 +380,74 @@ class IDAT(Chunk):
         return True
 
 
+COLOR_TYPE_NAMES = {
+    0: "Greyscale",
+    2: "Truecolour",
+    3: "Indexed-colour",
+    4: "Greyscale_with_alpha",
+    6: "Truecolour_with_alpha"
+}
+
+
+class HeaderData(NamedTuple):
+    """
+    Immutable IHDR fields, one record per parsed image
+    """
+    width: int
+    height: int
+    bit_depth: int
+    color_type: int
+    color_type_str: str
+    compression_method: int
+    filter_method: int
+    interlace_method: int
+
+
 class IHDR(Chunk):
-    hdr_data = {
-        "width": int,
-        "height": int,
-        "bit_depth": int,
-        "color_type": int,
-        "color_type_str": str(None),
-        "compression_method": int,
-        "filter_method": int,
-        "interlace_method": int
-    }
-
-    def __init__(self) -> None:
-        pass
+    __slots__ = ('hdr_data',)
 
     def process_hdr_data(self) -> bool:
         """
-        Processes the image data from raw bytes to hdr_data values,
+        Processes the image data from raw bytes to a HeaderData record,
         as well as determines decoded color_type, checks if given bit_depth
         is allowed with this color_type
         """
-        self.hdr_data["width"] = int.from_bytes(self.chunk_data[0:4], 'big')
-        self.hdr_data["height"] = int.from_bytes(self.chunk_data[4:8], 'big')
-        self.hdr_data["bit_depth"] = int(self.chunk_data[8])
-        self.hdr_data["color_type"] = int(self.chunk_data[9])
-        self.hdr_data["compression_method"] = int(self.chunk_data[10])
-        self.hdr_data["filter_method"] = int(self.chunk_data[11])
-        self.hdr_data["interlace_method"] = int(self.chunk_data[12])
+        color_type = int(self.chunk_data[9])
+        self.hdr_data = HeaderData(
+            width=int.from_bytes(self.chunk_data[0:4], 'big'),
+            height=int.from_bytes(self.chunk_data[4:8], 'big'),
+            bit_depth=int(self.chunk_data[8]),
+            color_type=color_type,
+            color_type_str=COLOR_TYPE_NAMES.get(color_type, str(None)),
+            compression_method=int(self.chunk_data[10]),
+            filter_method=int(self.chunk_data[11]),
+            interlace_method=int(self.chunk_data[12]))
         if not self.color_type_to_str():
             return False
         if not self.check_bit_depth_by_color_type():
             return False
+        return True
 
-    def get_hdr_data(self) -> dict:
+    def get_hdr_data(self) -> HeaderData:
         return self.hdr_data
 
     def color_type_to_str(self) -> bool:
         """
-        Sets hdr_data["color_type_str"] based on the color_type int
+        Checks that hdr_data.color_type has a str name
 
         Returns:
         True if possible to give str name, False otherwise
         """
-        color_num = self.hdr_data["color_type"]
-        if color_num == 0:
-            self.hdr_data["color_type_str"] = "Greyscale"
-        elif color_num == 2:
-            self.hdr_data["color_type_str"] = "Truecolour"
-        elif color_num == 3:
-            self.hdr_data["color_type_str"] = "Indexed-colour"
-        elif color_num == 4:
-            self.hdr_data["color_type_str"] = "Greyscale_with_alpha"
-        elif color_num == 6:
-            self.hdr_data["color_type_str"] = "Truecolour_with_alpha"
-        else:
+        color_num = self.hdr_data.color_type
+        if color_num not in COLOR_TYPE_NAMES:
             log.error(
                 "ERROR: Color code from IHDR is wrong and equals %d", color_num)
             return False
         return True
 
     def check_bit_depth_by_color_type(self) -> bool:
-        color_num = self.hdr_data["color_type"]
-        b_d = self.hdr_data["bit_depth"]
+        color_num = self.hdr_data.color_type
+        b_d = self.hdr_data.bit_depth
         if color_num == 0 and b_d in (1, 2, 4, 8, 16):
             return True
         elif color_num == 3 and b_d in (1, 2, 4, 8):
@@ -286,35 +456,32 @@ class IHDR(Chunk):
             return True
         else:
             log.error(
-                "ERROR: Given bit depth (%d) is not allowed when color_type is %s (%d)", self.hdr_data["bit_depth"], self.hdr_data["color_type_str"], self.hdr_data["color_type"])
+                "ERROR: Given bit depth (%d) is not allowed when color_type is %s (%d)", b_d, self.hdr_data.color_type_str, color_num)
             return False
     
     def assert_chunk(self) -> bool:
-        if self.hdr_data["color_type"] not in [0, 2, 3, 4, 6]:
+        if self.hdr_data.color_type not in [0, 2, 3, 4, 6]:
             log.error("ERROR: Color type is not valid")
             return False
-        if self.hdr_data["bit_depth"] not in [1, 2, 4, 8, 16]:
+        if self.hdr_data.bit_depth not in [1, 2, 4, 8, 16]:
             log.error("ERROR: Bit depth is not valid")
             return False
         return True
 
 
 class PLTE(Chunk):
-    plte_data = []
-
-    def __init__(self) -> None:
-        pass
+    __slots__ = ('plte_data',)
 
     def process_plte_data(self) -> None:
         if self.chunk_length % 3 != 0:
+            self.plte_data = np.zeros((0, 3), dtype=np.uint8)
             return False
-        for i in range(0, self.chunk_length, 3):
-            self.plte_data.append(
-                (self.chunk_data[i], self.chunk_data[i+1], self.chunk_data[i+2]))
-        log.info(
-            f"Printing the palette list of RGB tuples: {self.plte_data}, of length {len(self.plte_data)}")
+        # one (N, 3) array per chunk, copied so it does not pin the file buffer
+        self.plte_data = np.frombuffer(
+            self.chunk_data, dtype=np.uint8).reshape(-1, 3).copy()
+        log.info("Palette of %d RGB entries", len(self.plte_data))
 
-    def get_plte_data(self) -> list:
+    def get_plte_data(self) -> np.ndarray:
         return self.plte_data
     
     def assert_chunk(self) -> bool:
@@ -325,9 +492,7 @@ class PLTE(Chunk):
 
 
 class IEND(Chunk):
-
-    def __init__(self) -> None:
-        pass
+    __slots__ = ()
 
     def process_iend_data(self) -> bool:
         if self.chunk_length != 0:
@@ -344,8 +509,7 @@ class IEND(Chunk):
 
 
 class gAMA(Chunk):
-    def __init__(self) -> None:
-        pass
+    __slots__ = ('gamma',)
 
     def process_gama_data(self) -> bool:
         if self.chunk_length != 4:
@@ -367,8 +531,8 @@ class gAMA(Chunk):
 
 
 class cHRM(Chunk):
-    def __init__(self) -> None:
-        pass
+    __slots__ = ('white_point_x', 'white_point_y', 'red_x', 'red_y',
+                 'green_x', 'green_y', 'blue_x', 'blue_y')
 
     def process_chrm_data(self) -> bool:
         if self.chunk_length != 32:
@@ -408,8 +572,7 @@ class cHRM(Chunk):
         return True
 
 class bKGD(Chunk):
-    def __init__(self) -> None:
-        pass
+    __slots__ = ('background',)
 
     def process_bkgd_data(self) -> bool:
         if self.chunk_length not in (1, 2, 6):
@@ -440,8 +603,7 @@ class bKGD(Chunk):
 
 
 class sRGB(Chunk):
-    def __init__(self) -> None:
-        pass
+    __slots__ = ('rendering_intent',)
 
     def process_srgb_data(self) -> bool:
         if self.chunk_length != 1:
@@ -463,8 +625,7 @@ class sRGB(Chunk):
 
 
 class hIST(Chunk):
-    def __init__(self) -> None:
-        pass
+    __slots__ = ('histogram',)
 
     def process_hist_data(self) -> bool:
         if self.chunk_length % 2 != 0:
@@ -488,9 +649,37 @@ class hIST(Chunk):
         return True
 
 
+class tRNS(Chunk):
+    __slots__ = ('transparency',)
+
+    def process_trns_data(self, color_type: int) -> bool:
+        """
+        The layout of tRNS depends on the colour type of the image:
+        alpha of the palette entries (3), a transparent grey sample (0)
+        or a transparent RGB colour (2)
+        """
+        if color_type == 3:
+            self.transparency = np.frombuffer(
+                self.chunk_data, dtype=np.uint8).copy()
+        elif color_type == 0 and self.chunk_length == 2:
+            self.transparency = int.from_bytes(self.chunk_data, 'big')
+        elif color_type == 2 and self.chunk_length == 6:
+            self.transparency = (int.from_bytes(self.chunk_data[0:2], 'big'),
+                                 int.from_bytes(self.chunk_data[2:4], 'big'),
+                                 int.from_bytes(self.chunk_data[4:6], 'big'))
+        else:
+            log.error(
+                "ERROR: tRNS of length %d is invalid for color type %d", self.chunk_length, color_type)
+            return False
+        log.info(f"Transparency: {self.transparency}")
+        return True
+
+    def get_trns_data(self) -> Union[np.ndarray, int, tuple]:
+        return self.transparency
+
+
 class eXIf(Chunk):
-    def __init__(self) -> None:
-        pass
+    __slots__ = ('exif_endian', 'exif_endian_str', 'exif_fourty_two')
 
     def process_exif_data(self) -> bool:
         if self.chunk_length <= 0:
@@ -531,3 +720,19 @@ class eXIf(Chunk):
             log.error("ERROR: eXIF should have 42 as the next two bytes")
             return False
         return True
+
+
+# chunk type -> class of the chunk, other types are plain Chunk
+CHUNK_CLASSES = {
+    'IHDR': IHDR,
+    'IDAT': IDAT,
+    'PLTE': PLTE,
+    'IEND': IEND,
+    'gAMA': gAMA,
+    'cHRM': cHRM,
+    'sRGB': sRGB,
+    'eXIf': eXIf,
+    'bKGD': bKGD,
+    'hIST': hIST,
+    'tRNS': tRNS,
+}
@@ -0,0 +1,263 @@
+"""
+PNG encoder for NumPy images, filters are applied by filters.filter_scanlines
+and the data is compressed by zlib, nothing runs per pixel in Python:
+    with open(path, 'wb') as f, PngEncoder(f, width, height, bit_depth=8, color_type=2) as encoder:
+        encoder.write_rows(scanlines)      # (rows, stride) uint8, any number of bands
+        encoder.finish()
+write_png writes a whole (height, width, channels) uint8/uint16 array at once.
+With threads > 1 the filtered data is cut into segments deflated on a thread
+pool (zlib releases the GIL) and joined into one zlib stream, as pigz does:
+every segment ends on a full flush, is primed with the last 32 KiB of the
+segment before it and the Adler-32 checksums are combined.
+https://www.w3.org/TR/png/#5Chunk-layout
+"""
+import logging as log
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import chunk_class as chunk
+import filters
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+CHANNELS_BY_COLOR_TYPE = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+# same default as pypng
+IDAT_SIZE = 1 << 20
+# rows filtered at once by a filter strategy, which holds five filtered
+# copies of them (see filters.filter_candidates)
+STRATEGY_BAND_BYTES = 1 << 20
+# filtered bytes deflated by one thread at once
+DEFLATE_SEGMENT_BYTES = 1 << 20
+# deflate window, the dictionary a segment is primed with
+DEFLATE_WINDOW = 1 << 15
+ADLER_BASE = 65521
+
+
+def adler32_combine(adler1: int, adler2: int, length2: int) -> int:
+    """
+    Adler-32 of two pieces of data joined (zlib's adler32_combine)
+    ## Args:
+        - adler1 (int): checksum of the first piece
+        - adler2 (int): checksum of the second piece
+        - length2 (int): bytes in the second piece
+    ## Returns:
+        - int: checksum of both
+    """
+    remainder = length2 % ADLER_BASE
+    sum1 = adler1 & 0xffff
+    sum2 = remainder * sum1 % ADLER_BASE
+    sum1 = (sum1 + (adler2 & 0xffff) + ADLER_BASE - 1) % ADLER_BASE
+    sum2 = (sum2 + (adler1 >> 16) + (adler2 >> 16) + ADLER_BASE - remainder) % ADLER_BASE
+    return sum1 | (sum2 << 16)
+
+
+def deflate_segment(data: bytes, dictionary: bytes, level: int, strategy: int, last: bool) -> tuple:
+    """
+    Raw deflate data of one segment of a zlib stream, runs on a worker thread
+    ## Args:
+        - dictionary (bytes): end of the data before the segment, back references may reach it
+        - last (bool): ends the stream, otherwise the segment ends on a full flush
+    ## Returns:
+        - tuple: deflate data, Adler-32 of data
+    """
+    options = {'zdict': dictionary} if dictionary else {}
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, strategy, **options)
+    compressed = compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_FULL_FLUSH)
+    return compressed, zlib.adler32(data)
+
+
+class PngEncoder:
+    """
+    Writes a non-interlaced PNG file band by band: only one band and one
+    IDAT chunk worth of compressed data are held in memory
+    """
+
+    def __init__(self, output, width: int, height: int, bit_depth: int = 8, color_type: int = 6,
+                 chunks_before: list = (), chunks_after: list = (), level: int = zlib.Z_DEFAULT_COMPRESSION,
+                 strategy: int = zlib.Z_DEFAULT_STRATEGY, idat_size: int = IDAT_SIZE,
+                 filter_type=filters.FILTER_NONE, filter_strategy=None, threads: int = 1,
+                 segment_size: int = DEFLATE_SEGMENT_BYTES):
+        """
+        ## Args:
+            - output: writable binary file object (file, BytesIO, socket.makefile)
+            - chunks_before (list): chunk_class.Chunk objects written between IHDR and
+              IDAT (i.e. PLTE, tRNS, gAMA), in this order
+            - chunks_after (list): chunks written between IDAT and IEND
+            - level (int, optional): zlib compression level
+            - strategy (int, optional): zlib strategy, i.e. zlib.Z_FILTERED, zlib.Z_RLE
+            - idat_size (int, optional): data bytes per IDAT chunk (the last one can be shorter)
+            - filter_type (int, optional): filter type of every scanline (see filters.filter_scanlines)
+            - filter_strategy (str or callable, optional): chooses the filter type of every
+              scanline instead (see filters.FILTER_STRATEGIES)
+            - threads (int, optional): compression threads, 1 compresses on the calling thread
+            - segment_size (int, optional): filtered bytes per compressed segment with threads > 1
+        """
+        if color_type not in chunk.COLOR_TYPE_NAMES:
+            log.error("Invalid color type %s", color_type)
+            raise Exception("Invalid color type")
+        self.output = output
+        self.width = width
+        self.height = height
+        self.bit_depth = bit_depth
+        self.color_type = color_type
+        self.chunks_after = list(chunks_after)
+        self.idat_size = idat_size
+        self.filter_type = filter_type
+        self.filter_strategy = filter_strategy
+        channels = CHANNELS_BY_COLOR_TYPE[color_type]
+        self.stride = (width * channels * bit_depth + 7) // 8
+        self.bpp = max(1, channels * bit_depth // 8)
+        self.level = level
+        self.strategy = strategy
+        self.threads = threads
+        self.segment_size = segment_size
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, strategy)
+        self.pending = bytearray()
+        # parallel deflate state: filtered bytes not yet in a segment, end of
+        # the last segment, segments being compressed in order
+        self.executor = ThreadPoolExecutor(threads) if threads > 1 else None
+        self.uncompressed = bytearray()
+        self.dictionary = b''
+        self.segments = deque()
+        self.adler = 1
+        if self.executor is not None:
+            # zlib header of the level, the segments follow
+            self.pending += zlib.compress(b'', level)[:2]
+        self.prev = None
+        self.rows_written = 0
+
+        self.output.write(PNG_SIGNATURE)
+        self.write_chunk('IHDR', struct.pack('>IIBBBBB', width, height, bit_depth, color_type, 0, 0, 0))
+        for before in chunks_before:
+            self.write_chunk(before.get_chunk_type(), before.get_chunk())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """ Stops the compression threads, segments not compressed yet are dropped
+            Called by finish(), and on leaving a with block (also after an error)
+        """
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+            self.segments.clear()
+
+    def write_chunk(self, chunk_type: str, data: bytes):
+        """ Writes length, type, data and the CRC of type and data """
+        chunk_type = chunk_type.encode('ascii')
+        self.output.writelines([struct.pack('>I', len(data)) + chunk_type, data,
+                                struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type)))])
+
+    def write_rows(self, scanlines: np.ndarray):
+        """
+        Filters and compresses the next rows of the image
+        ## Args:
+            - scanlines (np.ndarray): uint8 array of shape (rows, stride), packed samples
+        """
+        rows = scanlines.shape[0]
+        if scanlines.shape[1:] != (self.stride,) or self.rows_written + rows > self.height:
+            log.error("Rows of shape %s do not fit the image", scanlines.shape)
+            raise Exception("Image size error")
+        if rows == 0:
+            return
+        if self.filter_strategy is None:
+            self.compress(filters.filter_scanlines(scanlines, self.bpp, self.filter_type, prev=self.prev))
+        else:
+            band_rows = max(1, STRATEGY_BAND_BYTES // max(1, self.stride))
+            for start in range(0, rows, band_rows):
+                prev = self.prev if start == 0 else scanlines[start - 1]
+                self.compress(filters.filter_adaptive(
+                    scanlines[start:start + band_rows], self.bpp, self.filter_strategy, prev=prev))
+        self.prev = scanlines[-1].copy()
+        self.rows_written += rows
+        self.write_full_idat_chunks()
+
+    def compress(self, filtered: np.ndarray):
+        if self.executor is None:
+            self.pending += self.compressor.compress(filtered)
+            return
+        self.uncompressed += filtered.tobytes()
+        full = len(self.uncompressed) // self.segment_size * self.segment_size
+        for start in range(0, full, self.segment_size):
+            self.submit_segment(bytes(self.uncompressed[start:start + self.segment_size]), False)
+        del self.uncompressed[:full]
+
+    def submit_segment(self, data: bytes, last: bool):
+        """ Starts compressing a segment, collects the oldest ones so at most
+            two segments per thread are held in memory
+        """
+        self.segments.append((self.executor.submit(
+            deflate_segment, data, self.dictionary, self.level, self.strategy, last), len(data)))
+        self.dictionary = (self.dictionary + data[-DEFLATE_WINDOW:])[-DEFLATE_WINDOW:]
+        while len(self.segments) > 2 * self.threads or (last and self.segments):
+            self.collect_segment()
+
+    def collect_segment(self):
+        future, length = self.segments.popleft()
+        compressed, adler = future.result()
+        self.pending += compressed
+        self.adler = adler32_combine(self.adler, adler, length)
+        self.write_full_idat_chunks()
+
+    def flush_compressor(self):
+        """ Ends the zlib stream """
+        if self.executor is None:
+            self.pending += self.compressor.flush()
+            return
+        self.submit_segment(bytes(self.uncompressed), True)
+        self.uncompressed = bytearray()
+        self.pending += struct.pack('>I', self.adler)
+        self.close()
+
+    def write_full_idat_chunks(self):
+        full = len(self.pending) // self.idat_size * self.idat_size
+        for start in range(0, full, self.idat_size):
+            self.write_chunk('IDAT', bytes(self.pending[start:start + self.idat_size]))
+        del self.pending[:full]
+
+    def finish(self):
+        """ Writes the rest of the image data, the chunks after IDAT and IEND """
+        if self.rows_written != self.height:
+            log.error("Missing %d scanlines in image data", self.height - self.rows_written)
+            raise Exception("Image size error")
+        self.flush_compressor()
+        self.write_full_idat_chunks()
+        if self.pending:
+            self.write_chunk('IDAT', bytes(self.pending))
+            self.pending = bytearray()
+        for after in self.chunks_after:
+            self.write_chunk(after.get_chunk_type(), after.get_chunk())
+        self.write_chunk('IEND', b'')
+
+
+def write_png(file_name: str, image: np.ndarray, bit_depth: int = None, color_type: int = None, **options) -> str:
+    """
+    Writes a whole image
+    ## Args:
+        - image (np.ndarray): (height, width) or (height, width, channels)
+          samples, uint8 (bit depths 1 to 8) or uint16 (bit depth 16)
+        - bit_depth (int, optional): defaults to 8 for uint8 and 16 for uint16 images
+        - color_type (int, optional): defaults to grey, grey + alpha, RGB or RGBA by channels
+        - options: see PngEncoder
+    ## Returns:
+        - str: file_name
+    """
+    if image.ndim == 2:
+        image = image[:, :, None]
+    height, width, channels = image.shape
+    if bit_depth is None:
+        bit_depth = 16 if image.dtype == np.uint16 else 8
+    if color_type is None:
+        color_type = {1: 0, 2: 4, 3: 2, 4: 6}[channels]
+    if CHANNELS_BY_COLOR_TYPE.get(color_type) != channels:
+        log.error("%d channels do not match color type %d", channels, color_type)
+        raise Exception("Invalid color type")
+    with open(file_name, 'wb') as f, PngEncoder(f, width, height, bit_depth, color_type, **options) as encoder:
+        encoder.write_rows(filters.pack_samples(image, bit_depth))
+        encoder.finish()
+    return file_name
@@ -1,9 +1,13 @@
+import math
 import numpy as np
 import sympy
 import random
 import chunk_class as chunk
 import logging as log
 import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from instrumentation import instrumented
 from Crypto.Cipher import AES
 from Crypto.Util.Padding import pad
 from Crypto.Util.Padding import unpad
@@ -15,42 +19,213 @@ from Crypto.Cipher import PKCS1_OAEP
 # https://en.wikipedia.org/wiki/RSA_(cryptosystem)
 # https://en.wikipedia.org/wiki/Block_cipher_mode_of_operation
 
+# ECB blocks handed to a worker process at once
+ECB_BATCH_BLOCKS = 256
+# conventional public exponent, to be passed as public_exponent; by default
+# (None) e is a random prime of half the key size
+PUBLIC_EXPONENT = 65537
+# after IEND data of the hybrid mode: magic, CTR nonce, RSA-OAEP wrapped AES key
+AES_CTR_MAGIC = b'AESCTR'
+AES_CTR_NONCE_SIZE = 8
+AES_KEY_SIZE = 32
+# enough for random candidates of 1024 bits and more (FIPS 186-4, table C.2)
+MILLER_RABIN_ROUNDS = 5
+# candidates sharing a factor with this are rejected before Miller-Rabin
+SMALL_PRIMES_PRODUCT = math.prod(sympy.primerange(3, 5000))
+
+
+def is_probable_prime(number: int, rounds: int = MILLER_RABIN_ROUNDS) -> bool:
+    """
+    # Miller-Rabin primality test
+    ## Args:
+        - number (int): odd number to test
+        - rounds (int, optional): random bases tried
+    ## Returns:
+        - bool: False if number is composite, True if it is prime with
+          high probability
+    """
+    if number < 5000:
+        return sympy.isprime(number)
+    if number % 2 == 0 or math.gcd(number, SMALL_PRIMES_PRODUCT) != 1:
+        return False
+    d, s = number - 1, 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+    for _ in range(rounds):
+        x = pow(random.SystemRandom().randrange(2, number - 1), d, number)
+        if x == 1 or x == number - 1:
+            continue
+        for _ in range(s - 1):
+            x = pow(x, 2, number)
+            if x == number - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def random_prime(bits: int, public_exponent: int = None) -> int:
+    """
+    # Random prime of exactly bits bits
+    The two top bits are set, so the product of two such primes has 2 * bits
+    bits. Odd candidates with small factors are dropped by one gcd with
+    SMALL_PRIMES_PRODUCT, only the survivors go through Miller-Rabin
+    ## Args:
+        - bits (int): prime size
+        - public_exponent (int, optional): the prime - 1 is made coprime with it
+    ## Returns:
+        - int: prime
+    """
+    generator = random.SystemRandom()
+    while True:
+        candidate = generator.getrandbits(bits) | (0b11 << (bits - 2)) | 1
+        if math.gcd(candidate, SMALL_PRIMES_PRODUCT) != 1:
+            continue
+        if public_exponent is not None and math.gcd(candidate - 1, public_exponent) != 1:
+            continue
+        if is_probable_prime(candidate):
+            return candidate
+
+
+def generate_keypair(key_size: int = 2048, public_exponent: int = None) -> tuple:
+    """
+    # New RSA keys
+    ## Args:
+        - key_size (int, optional): bits of n
+        - public_exponent (int, optional): e, i.e. PUBLIC_EXPONENT, defaults to
+          a random prime of key_size // 2 bits
+    ## Returns:
+        - tuple: public key (n, e), private key (n, d, p, q, dP, dQ, qInv)
+    """
+    prime_size = key_size // 2
+    p = random_prime(prime_size, public_exponent)
+    q = random_prime(prime_size, public_exponent)
+    while p == q:
+        q = random_prime(prime_size, public_exponent)
+    n = p * q
+    phi = (p - 1) * (q - 1)
+    e = public_exponent
+    while e is None or math.gcd(e, phi) != 1:
+        e = random_prime(prime_size)
+    d = pow(e, -1, phi)
+    return (n, e), crt_private_key(p, q, d)
+
+
+def xor_bytes(data: bytes, keystream: bytes) -> bytes:
+    """
+    # Xors data with the beginning of keystream, as whole integers
+    ## Args:
+        - data (bytes): data block
+        - keystream (bytes): at least as long as data
+    ## Returns:
+        - bytes: len(data) bytes
+    """
+    length = len(data)
+    return (int.from_bytes(data, byteorder='big') ^ int.from_bytes(keystream[:length], byteorder='big')) \
+        .to_bytes(length, byteorder='big')
+
+
+def iter_blocks(chunks, block_size: int):
+    """
+    # Regroups a stream of data into whole blocks
+    ## Args:
+        - chunks (iterable): bytes-like pieces of any size
+        - block_size (int): block size
+    ## Yields:
+        - bytes: pieces of whole blocks, the last piece holds the rest of the data
+    """
+    pending = bytearray()
+    for chunk in chunks:
+        if not pending and len(chunk) % block_size == 0:
+            # already whole blocks, passed on without copying
+            if len(chunk):
+                yield bytes(chunk)
+            continue
+        pending += chunk
+        whole = len(pending) // block_size * block_size
+        if whole:
+            yield bytes(pending[:whole])
+            del pending[:whole]
+    if pending:
+        yield bytes(pending)
+
+
+def rsa_power(value: int, key: tuple) -> int:
+    """
+    # value ** exponent mod n
+    ## Args:
+        - key (tuple): (n, exponent) or a CRT private key (n, d, p, q, dP, dQ, qInv)
+    ## Returns:
+        - int: result
+    """
+    if len(key) == 2:
+        return pow(value, key[1], key[0])
+    # two half-size exponentiations instead of one full one
+    _, _, p, q, d_p, d_q, q_inv = key
+    m_p = pow(value, d_p, p)
+    m_q = pow(value, d_q, q)
+    return m_q + (q_inv * (m_p - m_q) % p) * q
+
+
+def crt_private_key(p: int, q: int, d: int) -> tuple:
+    """
+    # Private key with the Chinese remainder theorem components
+    ## Returns:
+        - tuple: (n, d, p, q, d mod (p - 1), d mod (q - 1), q**-1 mod p)
+    """
+    return (p * q, d, p, q, d % (p - 1), d % (q - 1), pow(q, -1, p))
+
+
+def rsa_blocks(data: bytes, block_size: int, out_size: int, key: tuple) -> bytes:
+    """
+    # Raw RSA on consecutive blocks
+    Top level function, so that process pool workers can run it
+    ## Args:
+        - data (bytes): whole blocks of block_size bytes
+        - out_size (int): bytes of every result block (big endian)
+        - key (tuple): see rsa_power
+    ## Returns:
+        - bytes: the result blocks, in order
+    """
+    return b''.join(rsa_power(int.from_bytes(data[i:i + block_size], byteorder='big'), key)
+                    .to_bytes(out_size, byteorder='big')
+                    for i in range(0, len(data), block_size))
+
 
 class rsa2048:
 
-    def __init__(self, chunks_to_encrypt: list, key_size: int = 2048, public_key: tuple = None, private_key: tuple = None):
+    def __init__(self, chunks_to_encrypt: list, key_size: int = 2048, public_key: tuple = None, private_key: tuple = None,
+                 instrumentation=None, public_exponent: int = None, keystore=None):
         """ 
         # Chunk RSA2048 encryption
         User can provide public_key and private_key or generate new ones.
         ## Args:
             - png_type (png.Png): png object
             - public_key (tuple, optional): Defaults to None. (n, e)
-            - private_key (tuple, optional): Defaults to None. (n, d)
+            - private_key (tuple, optional): Defaults to None. (n, d, p, q, dP, dQ, qInv)
+              or (n, d), decryption is about 3 times faster with the CRT components
+            - instrumentation (instrumentation.Instrumentation, optional): times the modes
+            - public_exponent (int, optional): e of generated keys (i.e. PUBLIC_EXPONENT),
+              defaults to a random prime
+            - keystore (keystore.KeyStore, optional): new keys are taken from it instead of generated
         """
+        if instrumentation is not None:
+            instrumentation.attach(self)
 
         self.key_size = key_size
-        prime_size = key_size // 2
         if public_key is None:
-            p = sympy.randprime(2**(prime_size - 1), 2**prime_size-1)
-            q = sympy.randprime(2**(prime_size - 1), 2**prime_size-1)
-            while p == q:
-                q = sympy.randprime(2**(prime_size - 1), 2**prime_size-1)
-            n = p * q
-            phi = (p - 1) * (q - 1)
-            e = sympy.randprime(2**(prime_size - 1), 2**prime_size)
-            while sympy.gcd(e, phi) != 1 and e >= phi:
-                e = sympy.randprime(2**(prime_size - 1), 2**prime_size)
-            self.public_key = (n, e)
-        else:
-            self.public_key = public_key
-            n, e = public_key
-            
-
+            if keystore is not None:
+                public_key, generated_private_key = keystore.take()
+            else:
+                public_key, generated_private_key = generate_keypair(key_size, public_exponent)
+            if private_key is None:
+                private_key = generated_private_key
         if private_key is None:
-            d = sympy.mod_inverse(e, phi)
-            self.private_key = (n, d)
-        else:
-            self.private_key = private_key
+            log.error("Private key cannot be derived from a public key!")
+            raise Exception("Private key cannot be derived from a public key!")
+        self.public_key = public_key
+        self.private_key = private_key
 
         self.ENCRYPT_BLOCK_SIZE = self.key_size // 8 # which is 256
         self.ENCRYPT_BLOCK_SIZE_SUBTRACT = self.ENCRYPT_BLOCK_SIZE - 1
@@ -68,6 +243,32 @@ class rsa2048:
         self.chunks_to_encrypt = chunks_to_encrypt
         self.encrypted_pixels = []
         self.extra_bytes = b''
+        # worker pool of map_blocks, started on first use and kept for the
+        # following pieces and calls until close()
+        self.executor = None
+        self.executor_jobs = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """ Stops the worker processes of map_blocks """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+            self.executor_jobs = None
+
+    def get_executor(self, jobs: int) -> ProcessPoolExecutor:
+        """ The worker pool of map_blocks, restarted only when jobs changes """
+        if self.executor is not None and self.executor_jobs != jobs:
+            self.close()
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(jobs)
+            self.executor_jobs = jobs
+        return self.executor
 
     def get_public_key(self) -> tuple:
         """ Returns public key"""
@@ -85,6 +286,7 @@ class rsa2048:
         """ Returns decrypted pixels"""
         return self.decrypted_pixels
 
+    @instrumented()
     def encrypt_block_ecb(self, block: bytes) -> bytes:
         """ 
         # Encrypt block
@@ -93,47 +295,83 @@ class rsa2048:
         ## Returns:
             - bytes: encrypted block
         """
-        encrypted_int: int = pow(int.from_bytes(block, byteorder='big'),
-                                 self.public_key[1], self.public_key[0])
+        encrypted_int: int = rsa_power(int.from_bytes(block, byteorder='big'), self.public_key)
         encrypted_block = encrypted_int.to_bytes(
             self.ENCRYPT_BLOCK_SIZE, byteorder='big')
 
         return encrypted_block
 
+    def map_blocks(self, data: bytes, block_size: int, out_size: int, key: tuple, jobs: int = None) -> bytes:
+        """
+        # Raw RSA on whole blocks, in parallel
+        Batches of ECB_BATCH_BLOCKS blocks go to the process pool of this
+        object (see get_executor, close), the results are joined in order
+        ## Args:
+            - data (bytes): whole blocks of block_size bytes
+            - key (tuple): see rsa_power
+            - jobs (int, optional): worker processes, defaults to the number of CPUs, 1 runs in this process
+        ## Returns:
+            - bytes: out_size bytes per block
+        """
+        batch_size = ECB_BATCH_BLOCKS * block_size
+        batches = [data[i:i + batch_size] for i in range(0, len(data), batch_size)]
+        jobs = jobs or os.cpu_count()
+        if jobs == 1 or len(batches) < 2:
+            return b''.join(rsa_blocks(batch, block_size, out_size, key) for batch in batches)
+        executor = self.get_executor(jobs)
+        return b''.join(executor.map(rsa_blocks, batches, repeat(block_size), repeat(out_size), repeat(key)))
+
+    @instrumented()
+    def stream_encrypt_ECB(self, chunks, jobs: int = None):
+        """
+        # Encrypt a stream of data
+        Every 255-byte block becomes a 256-byte one: its first 255 bytes are
+        yielded, the last one goes to the extra bytes, which are complete
+        once the stream is exhausted. The last, shorter block is cut to its
+        own length
+        ## Args:
+            - chunks (iterable): bytes-like pieces of the data
+            - jobs (int, optional): worker processes (see map_blocks)
+        ## Yields:
+            - bytes: encrypted data
+        """
+        block_size = self.ENCRYPT_BLOCK_SIZE_SUBTRACT
+        extra_data = bytearray()
+        self.extra_bytes = b''
+        for piece in iter_blocks(chunks, block_size):
+            whole = len(piece) // block_size * block_size
+            encrypted = np.frombuffer(self.map_blocks(piece[:whole], block_size, self.ENCRYPT_BLOCK_SIZE,
+                                                      self.public_key, jobs), dtype=np.uint8)
+            encrypted = encrypted.reshape(-1, self.ENCRYPT_BLOCK_SIZE)
+            extra_data += encrypted[:, block_size:].tobytes()
+            yield encrypted[:, :block_size].tobytes()
+
+            last_block = piece[whole:]
+            if last_block:
+                yield self.encrypt_block_ecb(last_block)[0:len(last_block)]
+        self.extra_bytes = bytes(extra_data)
+
     # encrypt chunk using the Electronic codebook (ECB) mode
-    def encrypt_ECB(self, data_to_encrypt: bytes):
-        """ 
+    def encrypt_ECB(self, data_to_encrypt: bytes, jobs: int = None):
+        """
         # Encrypt chunk
         ## Args:
             - chunk (bytes): chunk to encrypt
+            - jobs (int, optional): worker processes (see map_blocks)
         ## Returns:
-            - bytes: encrypted chunk
+            - bytes: extra data
         """
+        self.encrypted_pixels = bytearray()
+        for encrypted in self.stream_encrypt_ECB([data_to_encrypt], jobs):
+            self.encrypted_pixels += encrypted
+        return self.extra_bytes
 
-        encrypted_data = b''
-        extra_data = b''
-
-        data_to_encrypt_blocks = [data_to_encrypt[i:i + self.ENCRYPT_BLOCK_SIZE_SUBTRACT]
-                                  for i in range(0, len(data_to_encrypt), self.ENCRYPT_BLOCK_SIZE_SUBTRACT)]
-
-        for data_to_encrypt_block in data_to_encrypt_blocks:
-
-            encrypted_block = self.encrypt_block_ecb(data_to_encrypt_block)
-
-            if len(data_to_encrypt_block) < self.ENCRYPT_BLOCK_SIZE_SUBTRACT:
-                self.encrypted_pixels += encrypted_block[0:len(
-                    data_to_encrypt_block)]
-                # self.extra_bytes += encrypted_block[len(data_to_encrypt_block):]
-            else:
-                self.encrypted_pixels += encrypted_block[0:
-                                                         self.ENCRYPT_BLOCK_SIZE_SUBTRACT]
-                extra_data += encrypted_block[self.ENCRYPT_BLOCK_SIZE_SUBTRACT:]
-
-        return extra_data
-
-    def encrypt_all_data_ECB(self, data_to_encrypt: bytes):
-        """ 
+    @instrumented()
+    def encrypt_all_data_ECB(self, data_to_encrypt: bytes, jobs: int = None):
+        """
         # Encrypt all chunks
+        ## Args:
+            - jobs (int, optional): worker processes (see map_blocks)
         ## Returns:
             - list: list of encrypted chunks
         """
@@ -141,11 +379,12 @@ class rsa2048:
         self.extra_bytes = b''
         self.encrypted_pixels = []
 
-        self.extra_bytes = self.encrypt_ECB(data_to_encrypt)
+        self.extra_bytes = self.encrypt_ECB(data_to_encrypt, jobs)
         # print(self.extra_bytes)
         # print(len(self.encrypted_pixels))
         return self.encrypted_chunks, self.extra_bytes
 
+    @instrumented()
     def decrypt_block_ecb(self, block: bytes) -> bytes:
         """ 
         # Decrypt block
@@ -154,65 +393,80 @@ class rsa2048:
         ## Returns:
             - bytes: decrypted block
         """
-        decrypted_int: int = pow(int.from_bytes(block, byteorder='big'),
-                                 self.private_key[1], self.private_key[0])
+        decrypted_int: int = rsa_power(int.from_bytes(block, byteorder='big'), self.private_key)
         decrypted_block = decrypted_int.to_bytes(
             self.ENCRYPT_BLOCK_SIZE_SUBTRACT, byteorder='big')
 
         return decrypted_block
 
-    def decrypt_ECB(self, data_to_decrypt: bytes):
-        """ 
+    def decrypt_ECB(self, data_to_decrypt: bytes, jobs: int = None):
+        """
         # Decrypt chunk
         ## Args:
             - chunk (bytes): chunk to decrypt
+            - jobs (int, optional): worker processes (see map_blocks)
         ## Returns:
             - bytes: decrypted chunk
         """
-        decrypted_data = b''
-
-        data_to_decrypt_blocks = [data_to_decrypt[i:i + self.ENCRYPT_BLOCK_SIZE]
-                                  for i in range(0, len(data_to_decrypt), self.ENCRYPT_BLOCK_SIZE)]
-
-        print(len(data_to_decrypt_blocks))
-        for data_to_decrypt_block in data_to_decrypt_blocks:
-            decrypted_block = self.decrypt_block_ecb(data_to_decrypt_block)
-
-            if (len(data_to_decrypt_block) < self.ENCRYPT_BLOCK_SIZE):
-                decrypted_data += decrypted_block[0:len(
-                    data_to_decrypt_block)]
-
-            else:
-                decrypted_data += decrypted_block[0:
-                                                  self.ENCRYPT_BLOCK_SIZE_SUBTRACT]
-
+        block_size = self.ENCRYPT_BLOCK_SIZE
+        whole = len(data_to_decrypt) // block_size * block_size
+        decrypted_data = self.map_blocks(data_to_decrypt[:whole], block_size, self.ENCRYPT_BLOCK_SIZE_SUBTRACT,
+                                         self.private_key, jobs)
+
+        last_block = data_to_decrypt[whole:]
+        if last_block:
+            decrypted_data += self.decrypt_block_ecb(last_block)[0:len(last_block)]
         return decrypted_data
 
-    def decrypt_all_data_ECB(self, data_to_decrypt: bytes, extra_data: bytes):
-        """ 
+    @instrumented()
+    def stream_decrypt_ECB(self, chunks, extra_data: bytes, jobs: int = None):
+        """
+        # Decrypt a stream of data
+        extra_data[j] is put back after the j-th 255-byte block before the
+        256-byte blocks are decrypted
+        ## Args:
+            - chunks (iterable): bytes-like pieces of the encrypted data
+            - extra_data (bytes): extra bytes of stream_encrypt_ECB
+            - jobs (int, optional): worker processes (see map_blocks)
+        ## Yields:
+            - bytes: decrypted data
+        """
+        block_size = self.ENCRYPT_BLOCK_SIZE_SUBTRACT
+        block_index = 0
+        # the last, shorter block and blocks past the end of the extra data
+        tail = bytearray()
+        for piece in iter_blocks(chunks, block_size):
+            if tail:
+                tail += piece
+                continue
+            whole = min(len(piece) // block_size, len(extra_data) - block_index)
+            joined = np.empty((whole, block_size + 1), dtype=np.uint8)
+            joined[:, :block_size] = np.frombuffer(
+                piece, dtype=np.uint8, count=whole * block_size).reshape(whole, block_size)
+            joined[:, block_size] = np.frombuffer(
+                extra_data, dtype=np.uint8, count=whole, offset=block_index)
+            block_index += whole
+            yield self.decrypt_ECB(joined.tobytes(), jobs)
+            tail += piece[whole * block_size:]
+
+        if tail:
+            if block_index < len(extra_data):
+                # only the last, shorter block is left, it gets an extra byte as well
+                tail += extra_data[block_index:block_index + 1]
+            yield self.decrypt_ECB(bytes(tail), jobs)
+
+    @instrumented()
+    def decrypt_all_data_ECB(self, data_to_decrypt: bytes, extra_data: bytes, jobs: int = None):
+        """
         # Decrypt all chunks
         ## Args:
             - encrypted_png_object (png.Png): encrypted png object
+            - jobs (int, optional): worker processes (see map_blocks)
         ## Returns:
             - png.Png: decrypted png object
         """
         self.decrypted_chunks = []
-        self.decrypted_pixels = []
-
-        # insert extra data[i] to every ENCRYPT_BLOCK_SIZE_SUBTRACT byte
-        data_to_decrypt_joined = b''
-        # extra data not read
-        for j, i in enumerate(range(0, len(data_to_decrypt), self.ENCRYPT_BLOCK_SIZE_SUBTRACT)):
-            if j < len(extra_data):
-                data_to_decrypt_joined += data_to_decrypt[i:i +
-                                                          self.ENCRYPT_BLOCK_SIZE_SUBTRACT]
-                data_to_decrypt_joined += extra_data[j:j+1]
-            else:
-                data_to_decrypt_joined += data_to_decrypt[i:i +
-                                                          self.ENCRYPT_BLOCK_SIZE_SUBTRACT]
-
-        # data_to_decrypt = zlib.decompress(all_idat_data)
-        self.decrypted_pixels = self.decrypt_ECB(data_to_decrypt_joined)
+        self.decrypted_pixels = b''.join(self.stream_decrypt_ECB([data_to_decrypt], extra_data, jobs))
 
         return self.decrypted_pixels
 
@@ -220,34 +474,41 @@ class rsa2048:
         """
         Output feedback encryption
         """
-        encrypted_block = b''
-        iv = self.encrypt_block_ecb(iv)
-        for i in range(len(data_to_encrypt_block)):
-            encrypted_block += bytes([data_to_encrypt_block[i] ^ iv[i]])
+        return xor_bytes(data_to_encrypt_block, self.encrypt_block_ecb(iv))
 
-        return encrypted_block
+    def make_iv_CFB(self) -> bytes:
+        """ Random initialization vector """
+        return os.urandom(self.ENCRYPT_BLOCK_SIZE_CFB)
+
+    @instrumented()
+    def stream_encrypt_CFB(self, chunks, iv: bytes):
+        """
+        Output feedback encryption of a stream of data, every block is
+        encrypted with the keystream of the previous encrypted block (iv for
+        the first one)
+        ## Yields:
+            - bytes: encrypted data
+        """
+        block_size = self.ENCRYPT_BLOCK_SIZE_CFB
+        for piece in iter_blocks(chunks, block_size):
+            piece = memoryview(piece)
+            encrypted = bytearray()
+            for i in range(0, len(piece), block_size):
+                iv = self.encrypt_block_CFB(piece[i:i + block_size], iv)
+                encrypted += iv
+            yield bytes(encrypted)
 
     def encrypt_CFB(self, data_to_encrypt: bytes, iv: bytes):
         """
         Output feedback encryption
         """
-        # divide data into blocks
-        data_to_encrypt_blocks = [data_to_encrypt[i:i + self.ENCRYPT_BLOCK_SIZE_CFB]
-                                  for i in range(0, len(data_to_encrypt), self.ENCRYPT_BLOCK_SIZE_CFB)]
-
-        original_iv = iv
+        self.encrypted_pixels = bytearray()
+        for encrypted in self.stream_encrypt_CFB([data_to_encrypt], iv):
+            self.encrypted_pixels += encrypted
 
-        # self.encrypted_pixels += iv
-
-        # encrypt blocks
-        for i, data_to_encrypt_block in enumerate(data_to_encrypt_blocks):
-            encrypted_block = self.encrypt_block_CFB(data_to_encrypt_block, iv)
-            self.encrypted_pixels += encrypted_block
-            iv = encrypted_block
-            print(i, len(data_to_encrypt_blocks))
-
-        return original_iv, self.encrypted_pixels
+        return iv, self.encrypted_pixels
 
+    @instrumented()
     def encrypt_all_data_CFB(self, data_to_encrypt: bytes):
         """ 
         # Encrypt all chunks
@@ -258,45 +519,51 @@ class rsa2048:
         self.extra_bytes = b''
         self.encrypted_pixels = []
 
-        iv = os.urandom(self.ENCRYPT_BLOCK_SIZE_CFB)
+        iv = self.make_iv_CFB()
 
         iv, self.encrypted_pixels = self.encrypt_CFB(data_to_encrypt, iv)
-        # print(self.extra_bytes)
-        # print(len(self.encrypted_pixels))
         return iv, self.encrypted_pixels
 
     def decrypt_block_CFB(self, encrypted_block, iv):
         """
         Decrypt a single block using CFB mode
         """
-        decrypted_block = b''
-        iv = self.encrypt_block_ecb(iv)
-
-        for i in range(len(encrypted_block)):
-            decrypted_byte = encrypted_block[i] ^ iv[i]
-            decrypted_block += bytes([decrypted_byte])
+        return xor_bytes(encrypted_block, self.encrypt_block_ecb(iv))
 
-        return decrypted_block
-
-    def decrypt_all_data_CFB(self, encrypted_data, iv):
+    @instrumented()
+    def stream_decrypt_CFB(self, chunks, iv: bytes, jobs: int = None):
+        """
+        Decrypts a stream of data encrypted in CFB mode
+        The keystream of every block comes from the previous encrypted block,
+        which is already known, so the keystreams of a whole piece are
+        computed at once (in parallel, see map_blocks) and xored with it
+        ## Args:
+            - jobs (int, optional): worker processes, defaults to the number of CPUs
+        ## Yields:
+            - bytes: decrypted data
+        """
+        block_size = self.ENCRYPT_BLOCK_SIZE_CFB
+        iv = bytes(iv)
+        for piece in iter_blocks(chunks, block_size):
+            blocks = -(-len(piece) // block_size)
+            # iv and every encrypted block of the piece but the last one
+            feedback = (iv + piece)[:blocks * block_size]
+            keystream = self.map_blocks(feedback, block_size, self.ENCRYPT_BLOCK_SIZE, self.public_key, jobs)
+            decrypted = np.bitwise_xor(np.frombuffer(piece, dtype=np.uint8),
+                                       np.frombuffer(keystream, dtype=np.uint8, count=len(piece)))
+            iv = piece[-block_size:]
+            yield decrypted.tobytes()
+
+    @instrumented()
+    def decrypt_all_data_CFB(self, encrypted_data, iv, jobs: int = None):
         """
         Decrypt all blocks of encrypted data using CFB mode
+        ## Args:
+            - jobs (int, optional): worker processes, defaults to the number of CPUs
         """
-        decrypted_data = b''
-
-        # Divide encrypted data into blocks
-        encrypted_blocks = [encrypted_data[i:i + self.ENCRYPT_BLOCK_SIZE_CFB]
-                            for i in range(0, len(encrypted_data), self.ENCRYPT_BLOCK_SIZE_CFB)]
-
-        # Decrypt blocks
-        for i, encrypted_block in enumerate(encrypted_blocks):
-            decrypted_block = self.decrypt_block_CFB(encrypted_block, iv)
-            decrypted_data += decrypted_block
-            iv = encrypted_block  # Use the encrypted block as IV for the next iteration
-            print(i, len(encrypted_blocks))
-
-        return decrypted_data
+        return b''.join(self.stream_decrypt_CFB([encrypted_data], iv, jobs))
 
+    @instrumented()
     def encrypt_all_data_AES_ECB(self, data_to_encrypt: bytes, public_key: tuple):
         """ 
         # Encrypt all chunks
@@ -325,6 +592,92 @@ class rsa2048:
                 extra_data += encrypted_block[self.ENCRYPT_BLOCK_SIZE_SUBTRACT_2:]
         return extra_data, self.encrypted_pixels
 
+    def get_rsa_key(self, private: bool = False) -> RSA.RsaKey:
+        """
+        # pycryptodome key
+        ## Args:
+            - private (bool, optional): with the private exponent (e comes from the public key
+              unless the private key has its primes)
+        ## Returns:
+            - RSA.RsaKey: key
+        """
+        n, e = self.public_key
+        if not private:
+            return RSA.construct((n, e))
+        if len(self.private_key) == 7:
+            n, d, p, q = self.private_key[:4]
+            e = pow(d, -1, (p - 1) * (q - 1))
+            return RSA.construct((n, e, d, p, q))
+        n, d = self.private_key
+        return RSA.construct((n, e, d))
+
+    @instrumented()
+    def stream_encrypt_AES_CTR(self, chunks):
+        """
+        # Hybrid encryption of a stream of data
+        The data is encrypted with AES-256 in CTR mode under a random session
+        key, only the session key is encrypted with RSA (OAEP). The extra
+        bytes (AES_CTR_MAGIC, nonce, wrapped key) are set before the first
+        piece is yielded
+        ## Yields:
+            - bytes: encrypted data
+        """
+        session_key = os.urandom(AES_KEY_SIZE)
+        nonce = os.urandom(AES_CTR_NONCE_SIZE)
+        wrapped_key = PKCS1_OAEP.new(self.get_rsa_key()).encrypt(session_key)
+        self.extra_bytes = AES_CTR_MAGIC + nonce + wrapped_key
+        cipher = AES.new(session_key, AES.MODE_CTR, nonce=nonce)
+        for chunk in chunks:
+            yield cipher.encrypt(chunk)
+
+    @instrumented()
+    def encrypt_all_data_AES_CTR(self, data_to_encrypt: bytes):
+        """
+        # Hybrid encryption (see stream_encrypt_AES_CTR)
+        ## Returns:
+            - tuple: after IEND data (AES_CTR_MAGIC, nonce, wrapped key), encrypted data
+        """
+        self.encrypted_chunks = []
+        self.encrypted_pixels = b''.join(self.stream_encrypt_AES_CTR([data_to_encrypt]))
+        return self.extra_bytes, self.encrypted_pixels
+
+    @instrumented()
+    def stream_decrypt_AES_CTR(self, chunks, extra_data: bytes):
+        """
+        # Hybrid decryption of a stream of data
+        ## Args:
+            - chunks (iterable): bytes-like pieces of the encrypted data
+            - extra_data (bytes): after IEND data written by stream_encrypt_AES_CTR
+        ## Yields:
+            - bytes: decrypted data
+        """
+        header_size = len(AES_CTR_MAGIC) + AES_CTR_NONCE_SIZE
+        if extra_data[:len(AES_CTR_MAGIC)] != AES_CTR_MAGIC or len(extra_data) != header_size + self.ENCRYPT_BLOCK_SIZE:
+            log.error("No AES-CTR session key after IEND!")
+            raise Exception("No AES-CTR session key after IEND!")
+        nonce = extra_data[len(AES_CTR_MAGIC):header_size]
+        try:
+            session_key = PKCS1_OAEP.new(self.get_rsa_key(private=True)).decrypt(extra_data[header_size:])
+        except ValueError:
+            log.error("AES-CTR session key does not match the private key!")
+            raise Exception("AES-CTR session key does not match the private key!")
+        cipher = AES.new(session_key, AES.MODE_CTR, nonce=nonce)
+        for chunk in chunks:
+            yield cipher.decrypt(chunk)
+
+    @instrumented()
+    def decrypt_all_data_AES_CTR(self, data_to_decrypt: bytes, extra_data: bytes):
+        """
+        # Hybrid decryption
+        ## Args:
+            - data_to_decrypt (bytes): encrypted data
+            - extra_data (bytes): after IEND data written by encrypt_all_data_AES_CTR
+        ## Returns:
+            - bytes: decrypted data
+        """
+        self.decrypted_pixels = b''.join(self.stream_decrypt_AES_CTR([data_to_decrypt], extra_data))
+        return self.decrypted_pixels
+
     def get_encrypted_chunks(self) -> list:
         """ 
         # Get all chunks
@@ -0,0 +1,451 @@
+"""
+Scanline filtering for PNG image data
+https://www.w3.org/TR/png/#9Filters
+https://www.w3.org/TR/png/#9Filter-types
+"""
+import logging as log
+import zlib
+import numpy as np
+
+FILTER_NONE = 0
+FILTER_SUB = 1
+FILTER_UP = 2
+FILTER_AVERAGE = 3
+FILTER_PAETH = 4
+
+
+def paeth_predictor(a, b, c):
+    """The Paeth Predictor computes a simple linear function of the three neighboring pixels (left, above, upper left),
+    then chooses as predictor the neighboring pixel closest to the computed value.
+    This technique is due to Alan W. Paeth [1].
+    Works both on ints and on numpy int16 arrays."""
+    if isinstance(a, np.ndarray):
+        # pa = |p - a| = |b - c|, pb = |p - b| = |a - c|, pc = |p - c| = |(a - c) + (b - c)|;
+        # the choice is made with multiplications by the comparisons, masked
+        # copies branch on every element and are several times slower
+        bc = b - c
+        ac = a - c
+        pa = np.abs(bc)
+        pb = np.abs(ac)
+        pc = np.abs(ac + bc)
+        use_a = pa <= pb
+        use_a &= pa <= pc
+        bc *= pb <= pc
+        ac -= bc
+        ac *= use_a
+        bc += ac
+        bc += c
+        return bc
+    p = a + b - c
+    pa = abs(p - a)
+    pb = abs(p - b)
+    pc = abs(p - c)
+    if pa <= pb and pa <= pc:
+        return a
+    elif pb <= pc:
+        return b
+    return c
+
+
+def unfilter_row(filter_type: int, line: np.ndarray, prev: np.ndarray, out: np.ndarray, bpp: int) -> np.ndarray:
+    """
+    Reconstructs a single scanline into out
+    ## Args:
+        - filter_type (int): filter type byte of the scanline
+        - line (np.ndarray): filtered scanline without the filter type byte
+        - prev (np.ndarray): reconstructed previous scanline (zeros for the first one)
+        - out (np.ndarray): uint8 array of the same length as line
+        - bpp (int): bytes per complete pixel, at least 1
+    ## Returns:
+        - np.ndarray: out
+    """
+    if filter_type == FILTER_NONE:
+        out[:] = line
+    elif filter_type == FILTER_SUB:
+        # every channel is a running sum (mod 256) of its own bytes
+        np.cumsum(line.reshape(-1, bpp), axis=0, dtype=np.uint8,
+                  out=out.reshape(-1, bpp))
+    elif filter_type == FILTER_UP:
+        np.add(line, prev, out=out)
+    elif filter_type in (FILTER_AVERAGE, FILTER_PAETH):
+        # every byte depends on the reconstructed one on its left, a lone row
+        # is a one row wavefront (one step per pixel)
+        filtered = np.empty((1, len(line) + 1), dtype=np.uint8)
+        filtered[0, 0] = filter_type
+        filtered[0, 1:] = line
+        _unfilter_wavefront(filtered, prev, out.reshape(1, -1), bpp)
+    else:
+        log.error(filter_type)
+        raise Exception('Invalid filter type')
+    return out
+
+
+def unfilter_scanlines(data, height: int, stride: int, bpp: int, prev: np.ndarray = None) -> np.ndarray:
+    """
+    Reconstructs filtered (and already decompressed) image data
+    ## Args:
+        - data (bytes-like): height scanlines, each a filter type byte followed by stride bytes
+        - height (int): number of scanlines
+        - stride (int): number of bytes in a reconstructed scanline
+        - bpp (int): bytes per complete pixel, at least 1
+        - prev (np.ndarray, optional): reconstructed scanline preceding data,
+          when data is a band from the middle of an image
+    ## Returns:
+        - np.ndarray: uint8 array of shape (height, stride) with the reconstructed data
+    """
+    if height == 0 or stride == 0:
+        return np.zeros((height, stride), dtype=np.uint8)
+    filtered = np.frombuffer(data, dtype=np.uint8,
+                             count=height * (stride + 1)).reshape(height, stride + 1)
+    filter_types = filtered[:, 0]
+    if filter_types.max() > FILTER_PAETH:
+        log.error(filter_types.max())
+        raise Exception('Invalid filter type')
+
+    out = np.empty((height, stride), dtype=np.uint8)
+    prev_out = np.zeros(stride, dtype=np.uint8) if prev is None else prev
+    r = 0
+    for first, last in _find_wavefront_blocks(filter_types, stride // bpp):
+        while r < first:
+            unfilter_row(filter_types[r], filtered[r, 1:], prev_out, out[r], bpp)
+            prev_out = out[r]
+            r += 1
+        _unfilter_wavefront(filtered[first:last + 1], prev_out, out[first:last + 1], bpp)
+        prev_out = out[last]
+        r = last + 1
+    while r < height:
+        unfilter_row(filter_types[r], filtered[r, 1:], prev_out, out[r], bpp)
+        prev_out = out[r]
+        r += 1
+    return out
+
+
+def _find_wavefront_blocks(filter_types: np.ndarray, width: int) -> list:
+    """
+    Groups the Average/Paeth rows into (first, last) blocks for _unfilter_wavefront.
+    A None/Sub/Up row inside a block costs one more diagonal, a new block
+    about width of them, so rows less than width apart share a block.
+    """
+    heavy = np.flatnonzero(filter_types >= FILTER_AVERAGE)
+    blocks = []
+    if len(heavy) == 0:
+        return blocks
+    first = last = int(heavy[0])
+    for row in heavy[1:]:
+        row = int(row)
+        if row - last > width:
+            blocks.append((first, last))
+            first = row
+        last = row
+    blocks.append((first, last))
+    return blocks
+
+
+def _unfilter_wavefront(filtered: np.ndarray, prev: np.ndarray, out: np.ndarray, bpp: int):
+    """
+    Reconstructs consecutive scanlines (any filter types) into out.
+    Pixel (j, x) only depends on (j, x-1), (j-1, x) and (j-1, x-1), so all
+    pixels on one anti-diagonal j + x = t are independent of each other: the
+    reconstruction takes len(rows) + width steps of whole-array operations.
+    The last two diagonals are kept in contiguous int16 arrays, so that only
+    reading the filtered bytes and writing out the result are strided.
+    """
+    rows = len(filtered)
+    width = (filtered.shape[1] - 1) // bpp
+    # pixel (j, x) is at j * width + x, a diagonal steps by width - 1
+    step = max(width - 1, 1)
+    raw = filtered[:, 1:].reshape(-1, bpp)
+    pixels = out.reshape(-1, bpp)
+    above = np.zeros((width + 1, bpp), dtype=np.int16)
+    above[:width] = prev.reshape(width, bpp)
+
+    types = filtered[:, 0]
+    average = (types == FILTER_AVERAGE)[:, None].astype(np.int16)
+    only_average = average.all()
+    if not average.any():
+        average = None
+    only_paeth = (types == FILTER_PAETH).all()
+    # Paeth(a, 0, 0) = a and Paeth(0, b, 0) = b: None, Sub and Up rows go
+    # through the Paeth predictor with some of the neighbours zeroed
+    keep_a = np.isin(types, (FILTER_SUB, FILTER_PAETH))[:, None].astype(np.int16)
+    keep_b = np.isin(types, (FILTER_UP, FILTER_PAETH))[:, None].astype(np.int16)
+    keep_c = (types == FILTER_PAETH)[:, None].astype(np.int16)
+
+    # diagonal t holds pixel (j, t - j) at index j + 1 and pixel (-1, t + 1)
+    # of prev at index 0, pixels left of the image stay zero
+    diagonals = [np.zeros((rows + 1, bpp), dtype=np.int16) for _ in range(3)]
+    diagonals[-1][0] = above[0]
+    for t in range(rows + width - 1):
+        j0 = max(0, t - width + 1)
+        j1 = min(rows - 1, t)
+        start = j0 * width + t - j0
+        stop = start + (j1 - j0) * step + 1
+        current, last, before = diagonals[t % 3], diagonals[(t - 1) % 3], diagonals[(t - 2) % 3]
+        current[0] = above[min(t + 1, width)]
+        a = last[j0 + 1:j1 + 2]
+        b = last[j0:j1 + 1]
+        c = before[j0:j1 + 1]
+
+        if only_average:
+            predicted = (a + b) >> 1
+        else:
+            if only_paeth:
+                predicted = paeth_predictor(a, b, c)
+            else:
+                predicted = paeth_predictor(a * keep_a[j0:j1 + 1], b * keep_b[j0:j1 + 1],
+                                            c * keep_c[j0:j1 + 1])
+            if average is not None:
+                mean = a + b
+                mean >>= 1
+                mean -= predicted
+                mean *= average[j0:j1 + 1]
+                predicted += mean
+        values = current[j0 + 1:j1 + 2]
+        np.add(raw[start:stop:step], predicted, out=values)
+        values &= 0xFF
+        pixels[start:stop:step] = values
+
+
+def filter_scanlines(scanlines: np.ndarray, bpp: int, filter_types=FILTER_NONE,
+                     prev: np.ndarray = None) -> np.ndarray:
+    """
+    Filters reconstructed scanlines, the inverse of unfilter_scanlines
+    Filtering only looks at unfiltered bytes, so every filter type is a
+    whole-array operation on the rows using it
+    ## Args:
+        - scanlines (np.ndarray): uint8 array of shape (height, stride)
+        - bpp (int): bytes per complete pixel, at least 1
+        - filter_types (int or np.ndarray): one filter type for all rows or one per row
+        - prev (np.ndarray, optional): scanline preceding scanlines, when they
+          are a band from the middle of an image
+    ## Returns:
+        - np.ndarray: uint8 array of shape (height, stride + 1), every row a
+          filter type byte followed by the filtered scanline
+    """
+    height, stride = scanlines.shape
+    filtered = np.empty((height, stride + 1), dtype=np.uint8)
+    filtered[:, 0] = filter_types
+    types = filtered[:, 0]
+    if types.max(initial=0) > FILTER_PAETH:
+        log.error(types.max())
+        raise Exception('Invalid filter type')
+
+    # left (a), upper (b) and upper left (c) neighbours, zero outside the
+    # image, built only for the filter types in use (None needs neither);
+    # None and Sub/Up only need uint8 arithmetic (mod 256 anyway)
+    used_types = np.unique(types)
+    if np.isin(used_types, (FILTER_SUB, FILTER_AVERAGE, FILTER_PAETH)).any():
+        a = np.zeros_like(scanlines)
+        a[:, bpp:] = scanlines[:, :-bpp]
+    if np.isin(used_types, (FILTER_UP, FILTER_AVERAGE, FILTER_PAETH)).any():
+        b = np.zeros_like(scanlines)
+        b[1:] = scanlines[:-1]
+        if prev is not None:
+            b[0] = prev
+
+    for filter_type in used_types:
+        rows = types == filter_type if len(used_types) > 1 else slice(None)
+        x = scanlines[rows]
+        if filter_type == FILTER_NONE:
+            filtered[rows, 1:] = x
+        elif filter_type == FILTER_SUB:
+            filtered[rows, 1:] = x - a[rows]
+        elif filter_type == FILTER_UP:
+            filtered[rows, 1:] = x - b[rows]
+        elif filter_type == FILTER_AVERAGE:
+            filtered[rows, 1:] = x - ((a[rows].astype(np.uint16) + b[rows]) >> 1).astype(np.uint8)
+        else:
+            b_rows = b[rows]
+            c = np.zeros_like(b_rows)
+            c[:, bpp:] = b_rows[:, :-bpp]
+            predicted = paeth_predictor(a[rows].astype(np.int16), b_rows.astype(np.int16), c.astype(np.int16))
+            filtered[rows, 1:] = x - predicted.astype(np.uint8)
+    return filtered
+
+
+def filter_candidates(scanlines: np.ndarray, bpp: int, prev: np.ndarray = None) -> np.ndarray:
+    """
+    Every row filtered with all five filter types
+    ## Returns:
+        - np.ndarray: uint8 array of shape (5, height, stride), indexed by filter type
+    """
+    return np.stack([filter_scanlines(scanlines, bpp, filter_type, prev=prev)[:, 1:]
+                     for filter_type in range(FILTER_PAETH + 1)])
+
+
+def select_fixed(filter_type: int):
+    """
+    Filter strategy using filter_type for every row
+    """
+    def select(candidates: np.ndarray) -> np.ndarray:
+        return np.full(candidates.shape[1], filter_type, dtype=np.uint8)
+    return select
+
+
+def select_min_sum(candidates: np.ndarray) -> np.ndarray:
+    """
+    Filter strategy recommended by the PNG specification (and used by
+    libpng): per row, the filter type with the minimum sum of absolute
+    differences, filtered bytes taken as signed
+    ## Args:
+        - candidates (np.ndarray): (5, height, stride) array of filter_candidates
+    ## Returns:
+        - np.ndarray: filter type of every row
+    """
+    sums = np.abs(candidates.view(np.int8).astype(np.int16)).sum(axis=2)
+    return sums.argmin(axis=0).astype(np.uint8)
+
+
+def select_trial(candidates: np.ndarray, level: int = 6) -> np.ndarray:
+    """
+    Brute-force filter strategy: per row, the filter type whose filtered row
+    compresses to the fewest bytes on its own. Slow, zlib runs five times per row
+    ## Args:
+        - candidates (np.ndarray): (5, height, stride) array of filter_candidates
+        - level (int, optional): zlib compression level of the trials
+    ## Returns:
+        - np.ndarray: filter type of every row
+    """
+    sizes = np.array([[len(zlib.compress(row, level)) for row in candidate] for candidate in candidates])
+    return sizes.argmin(axis=0).astype(np.uint8)
+
+
+# write side filter strategies by name, any callable mapping the
+# filter_candidates of a band to per-row filter types works as well
+FILTER_STRATEGIES = {
+    'none': select_fixed(FILTER_NONE),
+    'sub': select_fixed(FILTER_SUB),
+    'up': select_fixed(FILTER_UP),
+    'average': select_fixed(FILTER_AVERAGE),
+    'paeth': select_fixed(FILTER_PAETH),
+    'min_sum': select_min_sum,
+    'trial': select_trial,
+}
+
+
+def filter_adaptive(scanlines: np.ndarray, bpp: int, strategy, prev: np.ndarray = None) -> np.ndarray:
+    """
+    Filters every row with the filter type chosen by strategy
+    ## Args:
+        - strategy (str or callable): name in FILTER_STRATEGIES or a callable
+          taking filter_candidates and returning per-row filter types
+    ## Returns:
+        - np.ndarray: uint8 array of shape (height, stride + 1), as filter_scanlines
+    """
+    if isinstance(strategy, str):
+        if strategy not in FILTER_STRATEGIES:
+            log.error("Unknown filter strategy %s", strategy)
+            raise Exception('Invalid filter strategy')
+        strategy = FILTER_STRATEGIES[strategy]
+    height, stride = scanlines.shape
+    candidates = filter_candidates(scanlines, bpp, prev=prev)
+    types = np.asarray(strategy(candidates), dtype=np.uint8)
+    filtered = np.empty((height, stride + 1), dtype=np.uint8)
+    filtered[:, 0] = types
+    filtered[:, 1:] = candidates[types, np.arange(height)]
+    return filtered
+
+
+def unpack_scanlines(scanlines: np.ndarray, width: int, channels: int, bit_depth: int) -> np.ndarray:
+    """
+    Splits reconstructed scanlines into samples
+    ## Args:
+        - scanlines (np.ndarray): uint8 array of shape (height, stride)
+        - width (int): pixels in a scanline
+        - channels (int): samples per pixel
+        - bit_depth (int): 1, 2, 4, 8 or 16
+    ## Returns:
+        - np.ndarray: (height, width, channels), uint8 for bit depths up to 8
+          (packed samples are not rescaled), native uint16 for bit depth 16
+    """
+    height = scanlines.shape[0]
+    if bit_depth == 16:
+        samples = np.ascontiguousarray(scanlines).view('>u2').astype(np.uint16)
+    elif bit_depth == 8:
+        samples = scanlines
+    else:
+        # most significant bits first, every byte holds 8 // bit_depth samples
+        shifts = np.arange(8 - bit_depth, -1, -bit_depth, dtype=np.uint8)
+        samples = (scanlines[:, :, None] >> shifts) & np.uint8((1 << bit_depth) - 1)
+        samples = samples.reshape(height, -1)[:, :width * channels]
+    return samples.reshape(height, width, channels)
+
+
+def pack_samples(samples: np.ndarray, bit_depth: int) -> np.ndarray:
+    """
+    Inverse of unpack_scanlines
+    ## Args:
+        - samples (np.ndarray): (height, width, channels) array
+        - bit_depth (int): 1, 2, 4, 8 or 16
+    ## Returns:
+        - np.ndarray: uint8 array of shape (height, stride)
+    """
+    height = samples.shape[0]
+    if bit_depth == 16:
+        return samples.astype('>u2').view(np.uint8).reshape(height, -1)
+    flat = samples.reshape(height, -1).astype(np.uint8)
+    if bit_depth == 8:
+        return flat
+    per_byte = 8 // bit_depth
+    padding = -flat.shape[1] % per_byte
+    if padding:
+        flat = np.pad(flat, ((0, 0), (0, padding)))
+    shifts = np.arange(8 - bit_depth, -1, -bit_depth, dtype=np.uint8)
+    grouped = flat.reshape(height, -1, per_byte) << shifts
+    return np.bitwise_or.reduce(grouped, axis=2)
+
+
+# Adam7 passes: (first column, first row, column step, row step)
+ADAM7_PASSES = [(0, 0, 8, 8), (4, 0, 8, 8), (0, 4, 4, 8), (2, 0, 4, 4),
+                (0, 2, 2, 4), (1, 0, 2, 2), (0, 1, 1, 2)]
+# (width, height) of the block of the image a pixel of each pass stands for
+# until the following passes are decoded
+ADAM7_BLOCKS = [(8, 8), (4, 8), (4, 4), (2, 4), (2, 2), (1, 2), (1, 1)]
+
+
+def adam7_pass_size(pass_index: int, width: int, height: int) -> tuple:
+    """
+    Returns (width, height) of the reduced image of pass pass_index (0 to 6)
+    Either can be 0, such a pass has no scanlines at all
+    """
+    x0, y0, dx, dy = ADAM7_PASSES[pass_index]
+    return max(0, (width - x0 + dx - 1) // dx), max(0, (height - y0 + dy - 1) // dy)
+
+
+def scatter_pass(image: np.ndarray, samples: np.ndarray, pass_index: int, fill: bool = False):
+    """
+    Writes the samples of one reduced image into its pixels of image
+    with a single strided assignment
+    ## Args:
+        - image (np.ndarray): (height, width, channels) output array
+        - samples (np.ndarray): (pass height, pass width, channels) reduced image
+        - pass_index (int): 0 to 6
+        - fill (bool): also fill the rest of the block each pixel stands for,
+          for previews which stop before the last pass
+    """
+    x0, y0, dx, dy = ADAM7_PASSES[pass_index]
+    block_width, block_height = ADAM7_BLOCKS[pass_index] if fill else (1, 1)
+    for oy in range(block_height):
+        for ox in range(block_width):
+            target = image[y0 + oy::dy, x0 + ox::dx]
+            target[...] = samples[:target.shape[0], :target.shape[1]]
+
+
+def expand_packed_indices(scanlines: np.ndarray, palette: np.ndarray, width: int, bit_depth: int) -> np.ndarray:
+    """
+    Expands palette indices straight from reconstructed scanlines with a single
+    gather on a table holding the pixels of every possible byte value
+    ## Args:
+        - scanlines (np.ndarray): uint8 array of shape (height, stride)
+        - palette (np.ndarray): (256, channels) uint8 palette
+        - width (int): pixels in a scanline
+        - bit_depth (int): 1, 2, 4 or 8
+    ## Returns:
+        - np.ndarray: (height, width, channels) uint8 array
+    """
+    per_byte = 8 // bit_depth
+    byte_values = np.arange(256, dtype=np.uint8).reshape(256, 1)
+    indices = unpack_scanlines(byte_values, per_byte, 1, bit_depth)[:, :, 0]
+    table = palette[indices]
+    height = scanlines.shape[0]
+    return table[scanlines].reshape(height, -1, palette.shape[1])[:, :width]
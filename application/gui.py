@@ -6,6 +6,7 @@ from PyQt6 import QtCore
 import png_class as png
 from chunk_class import IHDR, PLTE
 import glob
+import logging as log
 import matplotlib.pyplot as plt
 import numpy as np
 import os
@@ -388,14 +389,17 @@ class MainWindow(QMainWindow):
     def display_image_and_hdr_data(self):
         self.png_path = self.png_input_field.currentText()
         print(self.png_path)
-        # Load image with OpenCV
-        image = cv.imread(self.png_path)
+        # Load image with our own decoder
+        self.png_type = None
+        try:
+            self.png_type = png.Png(self.png_path)
+            image = self.png_type.to_rgb_array()
+        except Exception:
+            log.exception("Unable to decode %s", self.png_path)
+            image = None
 
         # Display image
         if image is not None:
-            if self.png_type is not None:
-                self.png_type = None
-            image = cv.cvtColor(image, cv.COLOR_BGR2RGB)
             height, width, channel = image.shape
             bytes_per_channel = channel * (image.dtype.itemsize)
             qimage = QImage(image.data, width, height,
@@ -412,7 +416,6 @@ class MainWindow(QMainWindow):
 
     def load_image_values(self):
         try:
-            self.png_type = png.Png(self.png_path)
             print(self.png_type)
             self.png_input_label.setText("PNG path:")
             hdr = self.png_type.get_header()
@@ -432,13 +435,13 @@ class MainWindow(QMainWindow):
 
     def update_fields_from_header(self, hdr: IHDR):
         data = hdr.get_hdr_data()
-        self.width_field.setText(str(data["width"]))
-        self.height_field.setText(str(data["height"]))
-        self.bit_depth_field.setText(str(data["bit_depth"]))
-        self.color_type_field.setText(str(data["color_type_str"]))
-        self.compression_method_field.setText(str(data["compression_method"]))
-        self.filter_method_field.setText(str(data["filter_method"]))
-        self.interlace_method_field.setText(str(data["interlace_method"]))
+        self.width_field.setText(str(data.width))
+        self.height_field.setText(str(data.height))
+        self.bit_depth_field.setText(str(data.bit_depth))
+        self.color_type_field.setText(str(data.color_type_str))
+        self.compression_method_field.setText(str(data.compression_method))
+        self.filter_method_field.setText(str(data.filter_method))
+        self.interlace_method_field.setText(str(data.interlace_method))
 
         self.png_size = os.path.getsize(self.png_path)
 
@@ -446,14 +449,14 @@ class MainWindow(QMainWindow):
         data = plte.get_plte_data()
         self.palette_size_field.setText(str(len(data)))
         palette_data = ''
-        for dat in data:
-            palette_data += str(dat) + '\n'
+        for dat in data.tolist():
+            palette_data += str(tuple(dat)) + '\n'
 
         self.palette_data_field.insertPlainText(str(palette_data))
 
     def update_fourier_transform(self):
         # plot a phase and magnintude spectrum using pyqtgraph
-        img = cv.imread(self.png_path, cv.IMREAD_GRAYSCALE)
+        img = self.png_type.to_grey_array()
         pixmap = QPixmap.fromImage(QImage(img, img.shape[1], img.shape[0], img.strides[0],
                                           QImage.Format.Format_Grayscale8))
         pixmap = pixmap.scaled(self.GRAPH_WIDTH_AND_HEIGHT, self.GRAPH_WIDTH_AND_HEIGHT,
@@ -590,10 +593,10 @@ class MainWindow(QMainWindow):
 
     def update_anomized_image(self):
         self.anomized = png.AnomizedPng(self.png_path)
-        self.anomized.build_png_from_chunks('.tmp/anomized.png')
-        img = cv.imread('.tmp/anomized.png')
+        # the critical chunks are kept, the pixels are decoded from them directly
+        img = self.anomized.to_rgb_array()
         pixmap = QPixmap.fromImage(QImage(img, img.shape[1], img.shape[0], img.strides[0],
-                                          QImage.Format.Format_BGR888))
+                                          QImage.Format.Format_RGB888))
         pixmap = pixmap.scaled(self.GRAPH_WIDTH_AND_HEIGHT, self.GRAPH_WIDTH_AND_HEIGHT,
                                aspectRatioMode=QtCore.Qt.AspectRatioMode.KeepAspectRatio)
         self.anomized_image_label.setPixmap(pixmap)
@@ -610,4 +613,4 @@ class MainWindow(QMainWindow):
         self.anomized_data_deleted_chunks_list_field.setText(
             str(self.anomized.get_deleted_chunks_list()))
         self.anomized_data_updated_crc_number_field.setText(
-            str(self.anomized.get_crc_saved_bytes()))
+            str(self.anomized.get_updated_crc_count()))
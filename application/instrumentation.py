@@ -0,0 +1,172 @@
+"""
+Opt-in per-stage timing and counters:
+    aggregator = Aggregator()
+    png_file = Png(path, instrumentation=Instrumentation(aggregator))
+    png_file.to_array()
+    aggregator.summary()
+Methods marked with @instrumented are stages. Instrumentation.attach wraps
+them on one instance only, so objects created without instrumentation run
+the plain methods and pay nothing. Every call of a stage is sent to the sinks
+as an event dict: object, stage, seconds, bytes_in, bytes_out. Times are
+inclusive, a stage calling another stage counts its time as well.
+Stages may run on worker threads (pipelined decoding, threaded encoding),
+sinks are called under one lock and need no locking of their own.
+"""
+import inspect
+import json
+import threading
+import time
+import numpy as np
+
+
+def data_size(value) -> int:
+    """
+    Number of bytes in value, 0 for anything which is not data
+    """
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, memoryview):
+        return value.nbytes
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, list):
+        # encrypted pixels are kept as lists of ints
+        return len(value)
+    if isinstance(value, tuple):
+        return sum(data_size(item) for item in value)
+    return 0
+
+
+def arguments_size(obj, args: tuple, result) -> int:
+    return sum(data_size(arg) for arg in args)
+
+
+def result_size(obj, args: tuple, result) -> int:
+    return data_size(result)
+
+
+def instrumented(bytes_in=arguments_size, bytes_out=result_size):
+    """
+    Marks a method as an instrumented stage
+    ## Args:
+        - bytes_in (callable): (object, call arguments, result) -> bytes consumed
+        - bytes_out (callable): (object, call arguments, result) -> bytes produced
+    """
+    def mark(method):
+        method.instrumented_stage = (bytes_in, bytes_out)
+        return method
+    return mark
+
+
+class Instrumentation:
+    """
+    Sends the events of the stages of attached objects to sinks, any
+    callables taking an event dict (i.e. Aggregator, JsonLinesSink)
+    """
+
+    def __init__(self, *sinks):
+        self.sinks = list(sinks)
+        self.lock = threading.Lock()
+
+    def attach(self, obj):
+        """
+        Replaces the stage methods of obj (and only of obj) with timed ones
+        """
+        for name, method in inspect.getmembers(type(obj), inspect.isfunction):
+            stage = getattr(method, 'instrumented_stage', None)
+            if stage is None:
+                continue
+            bound = getattr(obj, name)
+            if inspect.isgeneratorfunction(method):
+                wrapper = self.wrap_generator(obj, name, bound)
+            else:
+                wrapper = self.wrap(obj, name, bound, *stage)
+            setattr(obj, name, wrapper)
+        return obj
+
+    def emit(self, obj, stage: str, seconds: float, bytes_in: int, bytes_out: int):
+        event = {"object": type(obj).__name__, "stage": stage, "seconds": seconds,
+                 "bytes_in": bytes_in, "bytes_out": bytes_out}
+        with self.lock:
+            for sink in self.sinks:
+                sink(event)
+
+    def wrap(self, obj, name: str, bound, bytes_in, bytes_out):
+        def timed_stage(*args, **kwargs):
+            start = time.perf_counter()
+            result = bound(*args, **kwargs)
+            seconds = time.perf_counter() - start
+            self.emit(obj, name, seconds, bytes_in(obj, args, result), bytes_out(obj, args, result))
+            return result
+        return timed_stage
+
+    def wrap_generator(self, obj, name: str, bound):
+        """
+        Generators are timed while they run (not while the caller handles
+        what they yield), one event is sent when they finish
+        """
+        def timed_generator(*args, **kwargs):
+            generator = bound(*args, **kwargs)
+            seconds = 0.0
+            produced = 0
+            try:
+                while True:
+                    start = time.perf_counter()
+                    try:
+                        item = next(generator)
+                    except StopIteration:
+                        seconds += time.perf_counter() - start
+                        return
+                    seconds += time.perf_counter() - start
+                    produced += data_size(item)
+                    yield item
+            finally:
+                generator.close()
+                self.emit(obj, name, seconds, 0, produced)
+        return timed_generator
+
+
+class Aggregator:
+    """
+    In-memory sink, totals per (object, stage)
+    """
+
+    def __init__(self):
+        self.totals = {}
+
+    def __call__(self, event: dict):
+        key = (event["object"], event["stage"])
+        total = self.totals.get(key)
+        if total is None:
+            total = self.totals[key] = {"calls": 0, "seconds": 0.0, "bytes_in": 0, "bytes_out": 0}
+        total["calls"] += 1
+        total["seconds"] += event["seconds"]
+        total["bytes_in"] += event["bytes_in"]
+        total["bytes_out"] += event["bytes_out"]
+
+    def summary(self) -> list:
+        """
+        Returns the totals as dicts, slowest stage first
+        """
+        rows = [{"object": obj, "stage": stage, **total}
+                for (obj, stage), total in self.totals.items()]
+        return sorted(rows, key=lambda row: row["seconds"], reverse=True)
+
+    def __str__(self) -> str:
+        lines = [f"{'stage':45} {'calls':>8} {'seconds':>10} {'MB in':>9} {'MB out':>9}"]
+        for row in self.summary():
+            lines.append(f"{row['object'] + '.' + row['stage']:45} {row['calls']:8d} {row['seconds']:10.4f} "
+                         f"{row['bytes_in'] / 1e6:9.2f} {row['bytes_out'] / 1e6:9.2f}")
+        return '\n'.join(lines)
+
+
+class JsonLinesSink:
+    """
+    Writes every event as a JSON line to an open text file
+    """
+
+    def __init__(self, output):
+        self.output = output
+
+    def __call__(self, event: dict):
+        self.output.write(json.dumps(event) + '\n')
@@ -0,0 +1,179 @@
+"""
+On-disk pool of pre-generated RSA keypairs:
+    store = KeyStore('.keys', target=4)
+    store.refill()                  # starts generating in the background
+    public_key, private_key = store.take()
+    encrypted = png.EncryptedPng(path, keystore=store)
+A keypair is one JSON file in the store directory, readable by the owner
+only. take() claims a file with an atomic rename, so several processes can
+share a directory and never get the same keypair. It waits for a keypair
+being generated (or generates one) only when the store is empty.
+The pool can be filled ahead of batch jobs:
+    python3 keystore.py .keys --count 16 [-j 4] [--public-exponent 65537]
+"""
+import argparse
+import json
+import logging as log
+import os
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from encryption import generate_keypair, PUBLIC_EXPONENT
+
+KEY_SUFFIX = '.key.json'
+
+
+class KeyStore:
+    def __init__(self, directory: str, key_size: int = 2048, public_exponent: int = None,
+                 target: int = 4, jobs: int = 1):
+        """
+        # Keypair pool
+        ## Args:
+            - directory (str): created if missing
+            - key_size (int, optional): bits of n
+            - public_exponent (int, optional): e of generated keys (i.e. PUBLIC_EXPONENT),
+              defaults to a random prime
+            - target (int, optional): keypairs refill() keeps ready
+            - jobs (int, optional): background worker processes
+        """
+        self.directory = directory
+        self.key_size = key_size
+        self.public_exponent = public_exponent
+        self.target = target
+        self.jobs = jobs
+        self.executor = None
+        self.pending = set()
+        # done callbacks run on an executor thread
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self, wait_pending: bool = True):
+        """ Stops the background workers, keypairs already generating are stored if wait_pending """
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait_pending, cancel_futures=not wait_pending)
+            self.executor = None
+            with self.lock:
+                self.pending.clear()
+
+    def key_files(self) -> list:
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.endswith(KEY_SUFFIX) and not name.startswith('.'))
+
+    def available(self) -> int:
+        """ Number of stored keypairs """
+        return len(self.key_files())
+
+    def store(self, keypair: tuple) -> str:
+        """
+        # Saves a keypair
+        Written under a hidden name first, so take() never sees half a file
+        ## Returns:
+            - str: path of the keypair file
+        """
+        (n, e), private_key = keypair
+        name = uuid.uuid4().hex + KEY_SUFFIX
+        temporary_path = os.path.join(self.directory, '.' + name)
+        with os.fdopen(os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as key_file:
+            json.dump({"key_size": self.key_size, "public_key": [n, e], "private_key": list(private_key)},
+                      key_file)
+        path = os.path.join(self.directory, name)
+        os.replace(temporary_path, path)
+        return path
+
+    def take(self) -> tuple:
+        """
+        # Hands out a keypair and removes it from the store
+        refill() is started after every take, so the pool stays at target
+        ## Returns:
+            - tuple: public key (n, e), private key (n, d, p, q, dP, dQ, qInv)
+        """
+        keypair = self.claim()
+        while keypair is None:
+            if self.pending:
+                # the done callbacks store the keypairs before they are claimed again
+                self.collect(wait(set(self.pending), return_when=FIRST_COMPLETED).done)
+                keypair = self.claim()
+            else:
+                log.info("Key store is empty, generating a keypair")
+                keypair = generate_keypair(self.key_size, self.public_exponent)
+        self.refill()
+        return keypair
+
+    def claim(self):
+        """ Returns a stored keypair (removing its file) or None if there is none """
+        for name in self.key_files():
+            path = os.path.join(self.directory, name)
+            claimed_path = os.path.join(self.directory, '.' + name + '.' + uuid.uuid4().hex)
+            try:
+                os.rename(path, claimed_path)
+            except FileNotFoundError:
+                # taken by another process
+                continue
+            with open(claimed_path) as key_file:
+                keys = json.load(key_file)
+            os.remove(claimed_path)
+            if keys["key_size"] != self.key_size:
+                log.error("Keypair of a wrong size in the key store!")
+                raise Exception("Keypair of a wrong size in the key store!")
+            return tuple(keys["public_key"]), tuple(keys["private_key"])
+        return None
+
+    def refill(self):
+        """ Starts generating keypairs in the background until target are stored or pending """
+        with self.lock:
+            missing = self.target - self.available() - len(self.pending)
+            if missing <= 0:
+                return
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(self.jobs)
+            futures = [self.executor.submit(generate_keypair, self.key_size, self.public_exponent)
+                       for _ in range(missing)]
+            self.pending.update(futures)
+        for future in futures:
+            future.add_done_callback(self.collect_one)
+
+    def collect(self, futures):
+        for future in futures:
+            self.collect_one(future)
+
+    def collect_one(self, future):
+        """ Stores the keypair of a finished (or waits for a pending) future, once """
+        keypair = None if future.cancelled() else future.result()
+        with self.lock:
+            if future not in self.pending:
+                return
+            self.pending.discard(future)
+            if keypair is not None:
+                self.store(keypair)
+
+    def fill(self, count: int):
+        """ Generates keypairs until count are stored, waits for them """
+        self.target = count
+        self.refill()
+        self.collect(list(self.pending))
+
+
+if __name__ == '__main__':
+    log.basicConfig(
+        format='%(levelname)s {%(pathname)s:%(lineno)d} %(asctime)s %(message)s', level=log.ERROR)
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory', help='key store directory')
+    parser.add_argument('--count', type=int, default=8, help='keypairs to keep ready')
+    parser.add_argument('--key-size', type=int, default=2048)
+    parser.add_argument('--public-exponent', type=int, default=None,
+                        help=f'e of the generated keys, e.g. {PUBLIC_EXPONENT} (default: a random prime)')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes (default: number of CPUs)')
+    args = parser.parse_args()
+
+    with KeyStore(args.directory, key_size=args.key_size, public_exponent=args.public_exponent,
+                  jobs=args.jobs or os.cpu_count()) as key_store:
+        key_store.fill(args.count)
+        print(f"{key_store.available()} keypairs in {args.directory}")
@@ -3,14 +3,71 @@ https://iter.ca/post/png/
 https://www.w3.org/TR/png/
 https://www.nayuki.io/page/png-file-chunk-inspector
 """
+import contextlib
+import io
 import logging as log
+import mmap
+import os
+import queue
+import threading
 import chunk_class as chunk
+import filters
+from instrumentation import instrumented
 import matplotlib.pyplot as plt
 import numpy as np
-import cv2 as cv
-from encryption import rsa2048
-import png
+from encryption import rsa2048, iter_blocks
 import zlib
+from encoder import PngEncoder
+
+# pixel bytes decoded at once while streaming (encryption modes, re-encoding), bands of a few rows
+# only would make the Average/Paeth wavefront (rows + width steps) slow
+STREAM_BAND_BYTES = 8 << 20
+# row buffers of the pipelined decoder, one is inflated while another is unfiltered
+PIPELINE_BAND_BYTES = 4 << 20
+PIPELINE_RING_BANDS = 3
+# images of fewer bands than this are decoded serially even when pipelined is asked for
+PIPELINE_MIN_BANDS = 2
+# buffers per os.writev call when IOV_MAX is unknown
+DEFAULT_IOV_MAX = 1024
+# chunks whose data lazily opened files leave in the file until it is asked for,
+# the other (small) chunks are read while the file is open
+LAZY_CHUNK_TYPES = ('IDAT',)
+
+
+def open_output(output, raw: bool = False):
+    """ Context manager giving a writable binary file object: output itself
+        when it has a write method (BytesIO, socket.makefile, pipe, opened
+        file; it is not closed), else the file named output, opened
+        unbuffered when raw
+    """
+    if hasattr(output, 'write'):
+        return contextlib.nullcontext(output)
+    return open(output, 'wb', buffering=0 if raw else -1)
+
+
+def write_pieces(output, pieces: list):
+    """ Writes buffers without joining them: os.writev on raw files
+        (io.FileIO), writelines on any other file object
+    """
+    if not isinstance(output, io.FileIO):
+        output.writelines(pieces)
+        return
+    try:
+        iov_max = os.sysconf('SC_IOV_MAX')
+    except (AttributeError, ValueError, OSError):
+        iov_max = DEFAULT_IOV_MAX
+    pieces = [memoryview(piece).cast('B') for piece in pieces if len(piece)]
+    while pieces:
+        batch = pieces[:iov_max]
+        written = os.writev(output.fileno(), batch)
+        # the rest of a short write goes in the next call
+        for index, piece in enumerate(batch):
+            if written < len(piece):
+                pieces = [piece[written:]] + pieces[index + 1:]
+                break
+            written -= len(piece)
+        else:
+            pieces = pieces[len(batch):]
 
 
 class Png:
@@ -18,81 +75,180 @@ class Png:
     Contains the PNG file signature and chunkss
     """
 
-    def __init__(self, file_png_name: str):
+    def __init__(self, file_png_name: str, use_mmap: bool = False, lazy: bool = False,
+                 crc_mode: str = chunk.CRC_OFF, instrumentation=None):
+        """
+        use_mmap maps the file into memory and builds the chunks from offsets,
+        chunk payloads are then memoryview slices of the mapping (no copies)
+        lazy reads the small chunks but only indexes the IDAT ones (type,
+        offset, length) and processes IHDR only, image data is read and the
+        other chunks are processed the first time they are asked for
+        crc_mode is one of chunk.CRC_STRICT, chunk.CRC_LAZY, chunk.CRC_OFF
+        The file is closed once it is parsed, lazily read data is read from
+        the file reopened by name
+        instrumentation (instrumentation.Instrumentation) times the stages
+        """
+        if instrumentation is not None:
+            instrumentation.attach(self)
         self.file_png_name = file_png_name
-        try:
-            self.file_png = open(file_png_name, 'rb')
-        except:
-            log.error("Failed to open file %s", file_png_name)
-            raise Exception("File error")
         self.signature = []
         self.chunks = []
+        self.chunk_index = {}
         self.ancilliary_dict = {}
-        self.read_signature()
-        self.read_chunks()
-        self.read_after_iend_data()
+        self.buffer = None
+        self.offset = 0
+        self.lazy = lazy
+        self.crc_mode = crc_mode
+        self.after_iend_data = None
+        self.chunks_processed = False
+        with self.open_file() as file_png:
+            if use_mmap:
+                self.map_file(file_png)
+            self.read_signature(file_png)
+            self.read_chunks(file_png)
+            if not lazy or use_mmap:
+                self.read_after_iend_data(file_png)
+            else:
+                self.offset = file_png.tell()
         self.process_header()
-        self.process_idat()
-        self.process_palette()
-        self.process_ending()
-        self.process_gama()
-        self.process_chrm()
-        self.process_bkgd()
-        self.process_srgb()
-        self.process_hist()
-        self.process_exif()
+        if not lazy:
+            self.process_chunks()
         # if self.assert_chunks() is False:
         # log.error("Chunk assertion failed!")
         # raise Exception("Chunk assertion failed!")
-        log.info("Ancilliary dictionary: %s", self.ancilliary_dict)
 
-    def __del__(self):
-        if not self.file_png.closed:
-            self.file_png.close()
+    @classmethod
+    def open(cls, file_png_name: str, lazy: bool = False, use_mmap: bool = False,
+             crc_mode: str = chunk.CRC_OFF, instrumentation=None) -> 'Png':
+        """
+        Png.open(path, lazy=True) returns as soon as IHDR and the other small
+        chunks are read and the IDAT chunks are indexed, without reading any
+        IDAT data, in a single pass over the file opened once
+        """
+        return cls(file_png_name, use_mmap=use_mmap, lazy=lazy, crc_mode=crc_mode,
+                   instrumentation=instrumentation)
 
     def __str__(self) -> str:
         # ret = [chunk.get_type() for chunk in self.chunks]
         return f"{self.get_chunk_types()}"
 
-    def read_signature(self) -> int:
+    def open_file(self):
+        try:
+            return open(self.file_png_name, 'rb')
+        except OSError:
+            log.error("Failed to open file %s", self.file_png_name)
+            raise Exception("File error")
 
-        self.signature = self.file_png.read(8)
+    def map_file(self, file_png):
+        # the mapping stays valid after file_png is closed
+        try:
+            file_map = mmap.mmap(file_png.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        except ValueError:
+            log.error("Failed to map file %s", self.file_png_name)
+            raise Exception("File error")
+        self.buffer = memoryview(file_map)
+
+    @instrumented()
+    def read_signature(self, file_png) -> int:
+
+        if self.buffer is not None:
+            self.signature = bytes(self.buffer[:8])
+            self.offset = len(self.signature)
+        else:
+            self.signature = file_png.read(8)
 
         log.info("Read signature:\n %s", self.signature)
         return len(self.signature)
 
-    def read_chunks(self):
-        while self.file_png.peek() != b'':
-            tmp = chunk.Chunk(self.file_png)
-            self.chunks.append(tmp)
+    @instrumented(bytes_in=lambda png_file, args, result: sum(c.get_chunk_size() for c in png_file.chunks))
+    def read_chunks(self, file_png):
+        if self.lazy and self.buffer is None:
+            while file_png.peek() != b'':
+                tmp = chunk.Chunk.from_index(file_png, self.crc_mode, LAZY_CHUNK_TYPES)
+                self.append_chunk(tmp)
+                if tmp.get_chunk_type() == 'IEND':
+                    break
+            return
+        if self.buffer is not None:
+            while self.offset < len(self.buffer):
+                tmp = chunk.Chunk.from_buffer(
+                    self.buffer, self.offset, self.crc_mode)
+                self.offset += tmp.get_chunk_size()
+                self.append_chunk(tmp)
+                if tmp.get_chunk_type() == 'IEND':
+                    break
+            return
+        while file_png.peek() != b'':
+            tmp = chunk.Chunk.from_file(file_png, self.crc_mode)
+            self.append_chunk(tmp)
             if tmp.get_chunk_type() == 'IEND':
                 break
 
-    def read_after_iend_data(self):
-        self.after_iend_data = b''
-        while self.file_png.peek() != b'':
-            self.after_iend_data += self.file_png.read(1)
+    @instrumented()
+    def read_after_iend_data(self, file_png):
+        if self.buffer is not None:
+            self.after_iend_data = self.buffer[self.offset:]
+        else:
+            self.after_iend_data = file_png.read()
 
     def get_signature(self) -> bytes:
         return self.signature
 
+    def append_chunk(self, new_chunk: chunk.Chunk):
+        self.chunk_index.setdefault(
+            new_chunk.get_chunk_type(), []).append(len(self.chunks))
+        self.chunks.append(new_chunk)
+
+    def index_chunks(self):
+        """
+        Rebuilds self.chunk_index (chunk type -> indices in self.chunks),
+        needed after self.chunks is modified other than by append_chunk
+        """
+        self.chunk_index = {}
+        for i, tmp in enumerate(self.chunks):
+            self.chunk_index.setdefault(tmp.get_chunk_type(), []).append(i)
+
+    def get_chunk_index(self, chunk_type: str) -> int or None:
+        """
+        Index of the first chunk_type chunk in self.chunks, None if there is none
+        """
+        indices = self.chunk_index.get(chunk_type)
+        return indices[0] if indices else None
+
     def get_chunk_types(self) -> list:
         return [chunk.get_chunk_type() for chunk in self.chunks]
 
     def get_ancilliary_dict(self) -> dict:
+        self.process_chunks()
         return self.ancilliary_dict
 
     def get_all_idat_chunks(self) -> list:
-        return [chunk for chunk in self.chunks if chunk.get_chunk_type() == 'IDAT']
+        return [self.chunks[i] for i in self.chunk_index.get('IDAT', [])]
+
+    def iter_idat_payloads(self):
+        """ Yields the data of the IDAT chunks in order, lazily indexed ones
+            are read from the file (opened once) and not kept in memory
+        """
+        with contextlib.ExitStack() as stack:
+            file_png = None
+            for idat in self.get_all_idat_chunks():
+                if file_png is None and idat.source is not None:
+                    file_png = stack.enter_context(self.open_file())
+                yield idat.read_payload(file_png)
 
     def get_ihdr_chunk(self) -> chunk.Chunk:
-        return [chunk for chunk in self.chunks if chunk.get_chunk_type() == 'IHDR'][0]
+        return self.chunks[self.chunk_index['IHDR'][0]]
 
     def get_after_iend_data(self) -> bytes:
+        if self.after_iend_data is None:
+            with self.open_file() as file_png:
+                file_png.seek(self.offset)
+                self.read_after_iend_data(file_png)
         return self.after_iend_data
 
     def check_if_plte_exists(self) -> bool:
-        return 'PLTE' in self.get_chunk_types()
+        return 'PLTE' in self.chunk_index
 
     def assert_chunks(self) -> bool:
         """
@@ -105,9 +261,33 @@ class Png:
                 return False
         return True
 
+    @instrumented()
+    def process_chunks(self) -> bool:
+        """
+        Runs the process_* passes of all chunks except IHDR, once
+        IDAT chunks need none, so in lazy mode no image data is read
+        """
+        if self.chunks_processed:
+            return True
+        self.chunks_processed = True
+        self.process_palette()
+        self.process_trns()
+        self.process_ending()
+        self.process_gama()
+        self.process_chrm()
+        self.process_bkgd()
+        self.process_srgb()
+        self.process_hist()
+        self.process_exif()
+        log.info("Ancilliary dictionary: %s", self.ancilliary_dict)
+        return True
+
+    @instrumented()
     def process_header(self) -> bool:
-        chunk_types = self.get_chunk_types()
-        index = chunk_types.index("IHDR")
+        index = self.get_chunk_index("IHDR")
+        if index is None:
+            log.error("No IHDR section in this image!")
+            raise Exception("IHDR error")
         ret = self.chunks[index].process_hdr_data()
         log.debug(
             f"Printing IHDR dictionary: {self.chunks[index].get_hdr_data()}")
@@ -119,10 +299,8 @@ class Png:
         return True
 
     def process_palette(self) -> bool:
-        chunk_types = self.get_chunk_types()
-        try:
-            index = chunk_types.index("PLTE")
-        except:
+        index = self.get_chunk_index("PLTE")
+        if index is None:
             log.info("No PLTE section in this image!")
             return False
         ret = self.chunks[index].process_plte_data()
@@ -133,16 +311,24 @@ class Png:
             log.info("Palette chunk processing OK")
         return True
 
-    def process_idat(self) -> bool:
-        chunk_types = self.get_chunk_types()
-        for i, type in enumerate(chunk_types):
-            if type == 'IDAT':
-                self.chunks[i].divide_chunk_into_sections()
+    def process_trns(self) -> bool:
+        index = self.get_chunk_index('tRNS')
+        if index is None:
+            log.info("No tRNS section in this image!")
+            return False
+        ret = self.chunks[index].process_trns_data(self.get_color_type())
+        if ret is False:
+            log.error("tRNS processing gone wrong!")
+            return False
+        else:
+            log.info("tRNS chunk processing OK")
+        transparency = self.chunks[index].get_trns_data()
+        self.ancilliary_dict['tRNS'] = transparency.tolist() if isinstance(
+            transparency, np.ndarray) else transparency
         return True
 
     def process_ending(self) -> bool:
-        chunk_types = self.get_chunk_types()
-        index = chunk_types.index('IEND')
+        index = self.get_chunk_index('IEND')
         ret = self.chunks[index].process_iend_data()
         if ret is False:
             log.error("IEND processing gone wrong!")
@@ -152,10 +338,8 @@ class Png:
         return True
 
     def process_gama(self) -> bool:
-        chunk_types = self.get_chunk_types()
-        try:
-            index = chunk_types.index('gAMA')
-        except:
+        index = self.get_chunk_index('gAMA')
+        if index is None:
             log.info("No gAMA section in this image!")
             return False
         ret = self.chunks[index].process_gama_data()
@@ -168,10 +352,8 @@ class Png:
         return True
 
     def process_chrm(self) -> bool:
-        chunk_types = self.get_chunk_types()
-        try:
-            index = chunk_types.index('cHRM')
-        except:
+        index = self.get_chunk_index('cHRM')
+        if index is None:
             log.info("No cHRM section in this image!")
             return False
         ret = self.chunks[index].process_chrm_data()
@@ -184,10 +366,8 @@ class Png:
         return True
 
     def process_bkgd(self) -> bool:
-        chunk_types = self.get_chunk_types()
-        try:
-            index = chunk_types.index('bKGD')
-        except:
+        index = self.get_chunk_index('bKGD')
+        if index is None:
             log.info("No bKGD section in this image!")
             return False
         ret = self.chunks[index].process_bkgd_data()
@@ -200,10 +380,8 @@ class Png:
         return True
 
     def process_srgb(self) -> bool:
-        chunk_types = self.get_chunk_types()
-        try:
-            index = chunk_types.index('sRGB')
-        except:
+        index = self.get_chunk_index('sRGB')
+        if index is None:
             log.info("No sRGB section in this image!")
             return False
         ret = self.chunks[index].process_srgb_data()
@@ -215,27 +393,9 @@ class Png:
         self.ancilliary_dict['sRGB'] = self.chunks[index].get_srgb_data()
         return True
 
-    def process_exif(self) -> bool:
-        chunk_types = self.get_chunk_types()
-        try:
-            index = chunk_types.index('eXIf')
-        except:
-            log.info("No eXIf section in this image!")
-            return False
-        ret = self.chunks[index].process_exif_data()
-        if ret is False:
-            log.error("eXIf processing gone wrong!")
-            return False
-        else:
-            log.info("eXIf chunk processing OK")
-        self.ancilliary_dict['eXIf'] = self.chunks[index].get_exif_data()
-        return True
-
     def process_hist(self) -> bool:
-        chunk_types = self.get_chunk_types()
-        try:
-            index = chunk_types.index('hIST')
-        except:
+        index = self.get_chunk_index('hIST')
+        if index is None:
             log.info("No hIST section in this image!")
             return False
         ret = self.chunks[index].process_hist_data()
@@ -248,10 +408,8 @@ class Png:
         return True
 
     def process_exif(self) -> bool:
-        chunk_types = self.get_chunk_types()
-        try:
-            index = chunk_types.index('eXIf')
-        except:
+        index = self.get_chunk_index('eXIf')
+        if index is None:
             log.info("No eXIf section in this image!")
             return False
         ret = self.chunks[index].process_exif_data()
@@ -264,8 +422,7 @@ class Png:
         return True
 
     def get_all_chunk_numbers(self) -> dict:
-        my_dict = {i: self.get_chunk_types().count(
-            i) for i in self.get_chunk_types()}
+        my_dict = {i: len(indices) for i, indices in self.chunk_index.items()}
         crit_chunks = ['IHDR', 'PLTE', 'IDAT', 'IEND']
         for i in crit_chunks:
             if i not in my_dict:
@@ -292,33 +449,21 @@ class Png:
         return True
 
     def get_header(self) -> chunk or None:
-        chunk_types = self.get_chunk_types()
-        index = chunk_types.index("IHDR")
+        index = self.get_chunk_index("IHDR")
         return self.chunks[index]
 
     def get_plte(self) -> chunk:
-        chunk_types = self.get_chunk_types()
-        try:
-            index = chunk_types.index("PLTE")
-        except:
+        self.process_chunks()
+        index = self.get_chunk_index("PLTE")
+        if index is None:
             log.info("No PLTE section in this image!")
             return None
         return self.chunks[index]
     
-    def get_exif(self) -> chunk:
-        chunk_types = self.get_chunk_types()
-        try:
-            index = chunk_types.index("eXIf")
-        except:
-            log.info("No eXIf section in this image!")
-            return None
-        return self.chunks[index]
-
     def get_exif(self) -> chunk.Chunk:
-        chunk_types = self.get_chunk_types()
-        try:
-            index = chunk_types.index("eXIf")
-        except:
+        self.process_chunks()
+        index = self.get_chunk_index("eXIf")
+        if index is None:
             log.info("No eXIf section in this image!")
             return None
         return self.chunks[index]
@@ -327,7 +472,7 @@ class Png:
         """ Print FFT of an image (shows magnitude and phase)
             Compare original image and inverted fft of original image (checks transformation)
         """
-        img = cv.imread(self.file_png_name, 0)
+        img = self.to_grey_array()
         fourier = np.fft.fft2(img)
         fourier_shifted = np.fft.fftshift(fourier)
 
@@ -377,41 +522,429 @@ class Png:
                 log.info("Found ancilliary chunk: %s", i.get_chunk_type())
         return ancilliary_chunks
 
-    def build_png_from_chunks(self, file_name: str) -> bool:
-        with open(file_name, 'wb') as f:
-            f.write(bytes(self.get_signature()))
+    @instrumented(bytes_out=lambda png_file, args, result: sum(c.get_chunk_size() for c in png_file.chunks))
+    def build_png_from_chunks(self, file_name, filter_strategy=None, threads: int = 1) -> bool:
+        """ Writes the chunks as they are, or with filter_strategy (see
+            filters.FILTER_STRATEGIES) or compression threads the image data
+            re-filtered and re-compressed in between the other chunks
+            file_name can be a writable binary file object as well (see open_output)
+        """
+        if filter_strategy is not None or threads > 1:
+            row_width = self.get_stride()
+            with open_output(file_name) as f, \
+                    self.get_png_encoder(f, filter_strategy=filter_strategy, threads=threads) as encoder:
+                for piece in self.iter_pixel_data():
+                    encoder.write_rows(np.frombuffer(piece, dtype=np.uint8).reshape(-1, row_width))
+                encoder.finish()
+            return True
+        with open_output(file_name, raw=True) as f:
             log.info("Signature: %s", self.get_signature())
-            for i in self.chunks:
-                f.write(i.all_chunk_data_to_bytes())
-
-                # log.info("Chunk type: %s", i.get_chunk_type())
+            write_pieces(f, self.to_pieces())
         return True
 
+    def to_pieces(self) -> list:
+        """ The signature and the pieces of every chunk (see Chunk.to_pieces) """
+        pieces = [bytes(self.get_signature())]
+        for i in self.chunks:
+            pieces.extend(i.to_pieces())
+        return pieces
+
+    def to_bytes(self) -> bytearray:
+        """ What build_png_from_chunks writes, in one buffer allocated at once """
+        pieces = self.to_pieces()
+        data = bytearray(sum(len(memoryview(piece).cast('B')) for piece in pieces))
+        view = memoryview(data)
+        position = 0
+        for piece in pieces:
+            piece = memoryview(piece).cast('B')
+            view[position:position + len(piece)] = piece
+            position += len(piece)
+        return data
+
+    @instrumented()
+    def get_and_prepare_data_to_process(self):
+        return self.decode_scanlines().tobytes()
+
+    def iter_pixel_data(self):
+        """ Yields the pixel bytes (packed scanlines without filter type bytes)
+            in bands of about STREAM_BAND_BYTES, interlaced images at once
+        """
+        if self.get_interlace_method() != 0:
+            yield self.get_and_prepare_data_to_process()
+            return
+        band_rows = max(1, STREAM_BAND_BYTES // self.get_stride())
+        for band in self.iter_scanlines(band_rows=band_rows):
+            yield band.tobytes()
+
+    def get_png_encoder(self, output, **options) -> PngEncoder:
+        """ Encoder for an image with the header (not interlaced) and the other
+            chunks (i.e. PLTE, tRNS, text) of this one, options go to PngEncoder
+        """
+        idat_indexes = self.chunk_index['IDAT']
+        chunks_before = [c for c in self.chunks[:idat_indexes[0]] if c.get_chunk_type() != 'IHDR']
+        chunks_after = [c for c in self.chunks[idat_indexes[-1] + 1:] if c.get_chunk_type() != 'IEND']
+        return PngEncoder(output, self.get_width(), self.get_height(), self.get_bit_depth(),
+                          self.get_color_type(), chunks_before, chunks_after, **options)
+
     def get_first_idat_chunk_index(self) -> int:
-        chunk_types = self.get_chunk_types()
-        return chunk_types.index('IDAT')
+        return self.get_chunk_index('IDAT')
 
     def replace_idat_chunks(self, new_idat_chunks: list) -> bool:
         """ Replaces IDAT chunks with new ones
             If there are no IDAT chunks, returns false
         """
-        chunk_types = self.get_chunk_types()
-        if 'IDAT' in chunk_types:
+        if 'IDAT' in self.chunk_index:
             first_idat_index = self.get_first_idat_chunk_index()
             self.chunks = self.chunks[:first_idat_index] + \
                 new_idat_chunks + \
                 self.chunks[first_idat_index+len(new_idat_chunks):]
+            self.index_chunks()
         else:
             return False
 
         return True
 
+    def get_bit_depth(self):
+        # get the bit_depth from ihdr chunk
+        return self.get_ihdr_chunk().get_hdr_data().bit_depth
+
+    def get_color_type(self):
+        return self.get_ihdr_chunk().get_hdr_data().color_type
+
+    def get_width(self):
+        return self.get_ihdr_chunk().get_hdr_data().width
+
+    def get_height(self):
+        return self.get_ihdr_chunk().get_hdr_data().height
+
+    def get_interlace_method(self):
+        return self.get_ihdr_chunk().get_hdr_data().interlace_method
+
+    def get_channels(self):
+        color_type_to_channels = {
+            0: 1,
+            2: 3,
+            3: 1,
+            4: 2,
+            6: 4
+        }
+        return color_type_to_channels[self.get_color_type()]
+
+    def calculate_bytes_per_pixel(self):
+        """ Bytes per complete pixel as the filters see it (at least 1 for
+            bit depths below 8)
+        """
+        return max(1, self.get_channels() * self.get_bit_depth() // 8)
+
+    def get_stride(self):
+        """ Bytes in one scanline, without the filter type byte
+        """
+        return (self.get_width() * self.get_channels() * self.get_bit_depth() + 7) // 8
+
+    def unfilter_scanlines(self, data_to_defilter: bytes) -> np.ndarray:
+        """ Returns a uint8 array of shape (height, stride) with reconstructed scanlines
+        """
+        return self.unfilter_band(data_to_defilter, self.get_height(),
+                                  self.get_stride(), self.calculate_bytes_per_pixel())
+
+    @instrumented(bytes_in=lambda png_file, args, result: len(args[1]) - len(args[0].unconsumed_tail))
+    def inflate(self, decompressor, data, max_length: int) -> bytes:
+        """ One step of the streaming decompression of the IDAT data
+        """
+        return decompressor.decompress(data, max_length)
+
+    @instrumented(bytes_in=lambda png_file, args, result: args[1] * (args[2] + 1))
+    def unfilter_band(self, data, rows: int, stride: int, bytes_per_pixel: int,
+                      prev: np.ndarray = None) -> np.ndarray:
+        """ filters.unfilter_scanlines, as a stage of its own
+        """
+        return filters.unfilter_scanlines(data, rows, stride, bytes_per_pixel, prev=prev)
+
+    @instrumented()
+    def iter_scanlines(self, band_rows: int = 1, pipelined: bool = False):
+        """ Decodes the image while reading IDAT chunks one by one
+            Yields uint8 arrays of shape (rows, stride) with up to band_rows
+            reconstructed scanlines, so only one band, the previous scanline
+            and one IDAT chunk are held in memory at a time
+            pipelined: inflates on a thread of its own while the bands are
+            unfiltered (see iter_scanlines_pipelined) when pipeline_pays says so
+        """
+        if self.get_interlace_method() != 0:
+            log.error("Interlaced images are decoded by iter_passes!")
+            raise Exception("Interlace error")
+        if pipelined and self.pipeline_pays(band_rows):
+            yield from self.iter_scanlines_pipelined(band_rows)
+            return
+        bytes_per_pixel = self.calculate_bytes_per_pixel()
+        stride = self.get_stride()
+        rows_left = self.get_height()
+        band_size = band_rows * (stride + 1)
+        decompressor = zlib.decompressobj()
+        pending = bytearray()
+        prev = None
+
+        for data in self.iter_idat_payloads():
+            while data and rows_left > 0:
+                pending += self.inflate(decompressor, data, band_size - len(pending))
+                data = decompressor.unconsumed_tail
+                if len(pending) == band_size:
+                    rows = min(band_rows, rows_left)
+                    band = self.unfilter_band(
+                        pending, rows, stride, bytes_per_pixel, prev=prev)
+                    prev = band[-1].copy()
+                    rows_left -= rows
+                    pending = bytearray()
+                    yield band
+                    # not kept while the next band is inflated
+                    del band
+
+        if rows_left > 0:
+            pending += decompressor.flush()
+            rows = min(rows_left, len(pending) // (stride + 1))
+            if rows > 0:
+                yield self.unfilter_band(
+                    pending, rows, stride, bytes_per_pixel, prev=prev)
+            rows_left -= rows
+        if rows_left != 0:
+            log.error("Missing %d scanlines in image data", rows_left)
+            raise Exception("Corrupted data")
+
+    def pipeline_pays(self, band_rows: int) -> bool:
+        """ Whether iter_scanlines_pipelined is worth its threads: the two
+            stages only overlap with a second CPU, and band n + 1 is inflated
+            while band n is unfiltered, so at best the shorter stage is hidden
+            once there are at least PIPELINE_MIN_BANDS bands. On one CPU, or
+            for images of one band, the threads only add hand-overs (0.7 to
+            1.0 times the serial speed measured on one CPU). Average/Paeth
+            rows add about width wavefront steps per band, so images much
+            wider than a band is tall pay for the bands (0.4 times on one CPU
+            for 3840x2160 Paeth) and need the second CPU to break even
+        """
+        bands = -(-self.get_height() // max(1, band_rows))
+        return bands >= PIPELINE_MIN_BANDS and (os.cpu_count() or 1) > 1
+
+    def iter_scanlines_pipelined(self, band_rows: int):
+        """ iter_scanlines with the two stages overlapped: a producer thread
+            inflates the IDAT data into a ring of PIPELINE_RING_BANDS row
+            buffers (inflate_bands), the calling thread unfilters the filled
+            ones and hands them back. zlib and NumPy release the GIL
+        """
+        bytes_per_pixel = self.calculate_bytes_per_pixel()
+        stride = self.get_stride()
+        rows_left = self.get_height()
+        band_size = band_rows * (stride + 1)
+        free_buffers = queue.Queue()
+        filled_buffers = queue.Queue()
+        for _ in range(PIPELINE_RING_BANDS):
+            free_buffers.put(bytearray(band_size))
+        producer = threading.Thread(target=self.inflate_bands, daemon=True,
+                                    args=(band_size, rows_left * (stride + 1), free_buffers, filled_buffers))
+        producer.start()
+        prev = None
+        try:
+            while rows_left > 0:
+                buffer, size = filled_buffers.get()
+                if buffer is None:
+                    if isinstance(size, Exception):
+                        raise size
+                    break
+                rows = min(band_rows, rows_left, size // (stride + 1))
+                band = self.unfilter_band(buffer, rows, stride, bytes_per_pixel, prev=prev)
+                free_buffers.put(buffer)
+                if rows == 0:
+                    break
+                prev = band[-1].copy()
+                rows_left -= rows
+                yield band
+                del band
+        finally:
+            # stops the producer when the consumer is closed early
+            free_buffers.put(None)
+            producer.join()
+        if rows_left != 0:
+            log.error("Missing %d scanlines in image data", rows_left)
+            raise Exception("Corrupted data")
+
+    def inflate_bands(self, band_size: int, image_size: int, free_buffers, filled_buffers):
+        """ Producer of iter_scanlines_pipelined: fills free buffers with up to
+            image_size bytes of inflated IDAT data, puts (buffer, bytes) on
+            filled_buffers, then (None, None) at the end or (None, exception)
+            Stops when it takes None from free_buffers
+        """
+        try:
+            decompressor = zlib.decompressobj()
+            left = image_size
+            buffer = free_buffers.get()
+            filled = 0
+            idat_payloads = self.iter_idat_payloads()
+            data = b''
+            last_idat = False
+            while left > 0 and buffer is not None:
+                if not data and not last_idat:
+                    data = next(idat_payloads, None)
+                    last_idat = data is None
+                    data = data or b''
+                out = self.inflate(decompressor, data, min(band_size - filled, left))
+                if last_idat and not out:
+                    break
+                data = decompressor.unconsumed_tail
+                buffer[filled:filled + len(out)] = out
+                filled += len(out)
+                left -= len(out)
+                if filled == band_size:
+                    filled_buffers.put((buffer, filled))
+                    buffer = free_buffers.get()
+                    filled = 0
+            if buffer is not None and filled > 0:
+                filled_buffers.put((buffer, filled))
+            filled_buffers.put((None, None))
+        except Exception as error:
+            filled_buffers.put((None, error))
+
+    @instrumented()
+    def iter_passes(self, passes: int = 7):
+        """ Yields (pass index, uint8 array of shape (pass height, pass stride))
+            for the reconstructed reduced images of the first passes Adam7
+            passes, decompressing only as much IDAT data as they need
+        """
+        width = self.get_width()
+        height = self.get_height()
+        bits_per_pixel = self.get_channels() * self.get_bit_depth()
+        bytes_per_pixel = self.calculate_bytes_per_pixel()
+        decompressor = zlib.decompressobj()
+        idat_payloads = self.iter_idat_payloads()
+        data = b''
+
+        for pass_index in range(min(passes, len(filters.ADAM7_PASSES))):
+            pass_width, pass_height = filters.adam7_pass_size(
+                pass_index, width, height)
+            if pass_width == 0 or pass_height == 0:
+                continue
+            pass_stride = (pass_width * bits_per_pixel + 7) // 8
+            pass_size = pass_height * (pass_stride + 1)
+            pending = bytearray()
+            while len(pending) < pass_size:
+                if not data:
+                    data = next(idat_payloads, None)
+                    if data is None:
+                        pending += decompressor.flush()
+                        break
+                pending += self.inflate(decompressor, data, pass_size - len(pending))
+                data = decompressor.unconsumed_tail
+            if len(pending) < pass_size:
+                log.error("Missing data of interlace pass %d", pass_index + 1)
+                raise Exception("Corrupted data")
+            yield pass_index, self.unfilter_band(
+                pending[:pass_size], pass_height, pass_stride, bytes_per_pixel)
+
+    @instrumented()
+    def decode_scanlines(self, pipelined: bool = False) -> np.ndarray:
+        """ Returns all reconstructed scanlines as a uint8 array of shape (height, stride)
+            Interlaced images are returned de-interlaced
+            pipelined: inflates and unfilters bands of PIPELINE_BAND_BYTES on
+            two threads (see iter_scanlines_pipelined) where that pays (see
+            pipeline_pays), not for interlaced images
+        """
+        if self.get_interlace_method() != 0:
+            return filters.pack_samples(self.decode_samples(), self.get_bit_depth())
+        band_rows = max(1, PIPELINE_BAND_BYTES // max(1, self.get_stride()))
+        if pipelined and self.pipeline_pays(band_rows):
+            bands = list(self.iter_scanlines(band_rows=band_rows, pipelined=True))
+            return bands[0] if len(bands) == 1 else np.concatenate(bands)
+        # one band, the engine is fastest on the whole image at once
+        bands = list(self.iter_scanlines(band_rows=self.get_height()))
+        return bands[0] if len(bands) == 1 else np.concatenate(bands)
+
+    @instrumented()
+    def decode_samples(self, passes: int = 7, pipelined: bool = False) -> np.ndarray:
+        """ Returns the samples as an array of shape (height, width, channels)
+            (see to_array). For interlaced images decoding can stop after the
+            first passes passes, the missing pixels are then filled from the
+            decoded ones (a blocky preview)
+        """
+        width = self.get_width()
+        height = self.get_height()
+        channels = self.get_channels()
+        bit_depth = self.get_bit_depth()
+        if self.get_interlace_method() == 0:
+            return filters.unpack_scanlines(self.decode_scanlines(pipelined), width, channels, bit_depth)
+
+        samples = np.zeros((height, width, channels),
+                           dtype=np.uint16 if bit_depth == 16 else np.uint8)
+        for pass_index, scanlines in self.iter_passes(passes):
+            pass_width, pass_height = filters.adam7_pass_size(
+                pass_index, width, height)
+            filters.scatter_pass(samples, filters.unpack_scanlines(scanlines, pass_width, channels, bit_depth),
+                                 pass_index, fill=passes < len(filters.ADAM7_PASSES))
+        return samples
+
+    def get_palette_array(self) -> np.ndarray:
+        """ Returns the palette as a (256, 3) uint8 array, or (256, 4) when
+            tRNS gives the entries an alpha. Entries missing from PLTE are
+            black, entries missing from tRNS are opaque
+        """
+        plte = self.get_plte()
+        entries = plte.get_plte_data()[:256] if plte is not None else np.zeros((0, 3), dtype=np.uint8)
+        alpha = self.ancilliary_dict.get('tRNS') if self.get_color_type() == 3 else None
+        if alpha is None:
+            palette = np.zeros((256, 3), dtype=np.uint8)
+            palette[:len(entries)] = entries
+            return palette
+        palette = np.zeros((256, 4), dtype=np.uint8)
+        palette[:, 3] = 255
+        palette[:len(entries), :3] = entries
+        alpha = alpha[:256]
+        palette[:len(alpha), 3] = alpha
+        return palette
+
+    @instrumented()
+    def to_array(self, passes: int = 7, pipelined: bool = False) -> np.ndarray:
+        """ Decodes the image into an array of shape (height, width, channels)
+            uint8 for bit depths up to 8 (samples are not rescaled), uint16
+            for bit depth 16. Indexed-colour images are expanded with the
+            palette into (height, width, 3), or (height, width, 4) with tRNS
+            passes < 7 gives a cheap preview of interlaced images
+            pipelined: see decode_scanlines
+        """
+        if self.get_color_type() != 3:
+            return self.decode_samples(passes, pipelined)
+        palette = self.get_palette_array()
+        if self.get_interlace_method() == 0:
+            # packed indices are expanded straight from the scanline bytes
+            return filters.expand_packed_indices(self.decode_scanlines(pipelined), palette,
+                                                 self.get_width(), self.get_bit_depth())
+        return palette[self.decode_samples(passes)[:, :, 0]]
+
+    def to_rgb_array(self, passes: int = 7) -> np.ndarray:
+        """ Returns a (height, width, 3) uint8 array for display, alpha is
+            dropped and samples are rescaled to 8 bits
+        """
+        pixels = self.to_array(passes)
+        if pixels.dtype == np.uint16:
+            pixels = (pixels >> 8).astype(np.uint8)
+        elif self.get_color_type() == 0 and self.get_bit_depth() < 8:
+            pixels = pixels * np.uint8(255 // ((1 << self.get_bit_depth()) - 1))
+        if pixels.shape[2] < 3:
+            return np.repeat(pixels[:, :, :1], 3, axis=2)
+        return np.ascontiguousarray(pixels[:, :, :3])
+
+    def to_grey_array(self, passes: int = 7) -> np.ndarray:
+        """ Returns a (height, width) uint8 array with the luma of the image
+        """
+        rgb = self.to_rgb_array(passes)
+        if self.get_color_type() in (0, 4):
+            return np.ascontiguousarray(rgb[:, :, 0])
+        luma = rgb @ np.array([0.299, 0.587, 0.114]) + 0.5
+        return luma.astype(np.uint8)
+
 
 class AnomizedPng(Png):
-    def __init__(self, file_png_name: str):
-        super().__init__(file_png_name)
+    def __init__(self, file_png_name: str, use_mmap: bool = False, crc_mode: str = chunk.CRC_OFF,
+                 instrumentation=None):
+        super().__init__(file_png_name, use_mmap=use_mmap, crc_mode=crc_mode,
+                         instrumentation=instrumentation)
         self.anomized_chunks = []
-        self.crc_saved_bytes = 0
+        self.updated_crc_count = 0
         self.remove_aucilliary_chunks()
         self.update_crcs()
         log.info("%s", self.__str__())
@@ -420,36 +953,41 @@ class AnomizedPng(Png):
     def __str__(self) -> str:
         return super().__str__() + "Anomized chunks: " + str(self.anomized_chunks)
 
+    @instrumented()
     def remove_aucilliary_chunks(self) -> bool:
-        chunk_types = self.get_chunk_types()
-        for i in chunk_types:
-            if i not in ['IHDR', 'PLTE', 'IDAT', 'IEND']:
-                self.anomized_chunks.append(i)
-                self.remove_chunk(i)
+        critical_chunks = []
+        for i in self.chunks:
+            if i.get_chunk_type() not in ['IHDR', 'PLTE', 'IDAT', 'IEND']:
+                self.anomized_chunks.append(i.get_chunk_type())
+            else:
+                critical_chunks.append(i)
+        self.chunks = critical_chunks
+        self.index_chunks()
         log.info("Removed %d chunks from image", len(self.anomized_chunks))
         return True
 
+    @instrumented()
     def update_crcs(self) -> bool:
+        """ Recomputes the CRCs of the remaining chunks, counts the stale ones
+        """
         for i in self.chunks:
-            if i.replace_crc(b'pppp') == True:
-                self.crc_saved_bytes += chunk.Chunk.CRC_FIELD_LEN
+            if i.update_crc() == True:
+                self.updated_crc_count += 1
                 log.debug("Updated CRC for chunk %s", i.get_chunk_type())
-            else:
-                log.error("Failed to update CRC for chunk %s",
-                          i.get_chunk_type())
         return True
 
-    def get_crc_saved_bytes(self) -> int:
-        return self.crc_saved_bytes
+    def get_updated_crc_count(self) -> int:
+        """ Number of chunks whose stored CRC was wrong and has been replaced
+        """
+        return self.updated_crc_count
 
     def remove_chunk(self, chunk_type: str) -> bool:
-        chunk_types = self.get_chunk_types()
-        try:
-            index = chunk_types.index(chunk_type)
-        except:
+        index = self.get_chunk_index(chunk_type)
+        if index is None:
             log.info("No %s section in this image!", chunk_type)
             return False
         self.chunks.pop(index)
+        self.index_chunks()
         return True
 
     def get_deleted_chunks_number(self) -> int:
@@ -458,18 +996,19 @@ class AnomizedPng(Png):
     def get_deleted_chunks_list(self) -> list:
         return self.anomized_chunks
 
-    def get_png_data_size(self) -> int:
-        return super().get_png_data_size() - self.get_crc_saved_bytes()
-
 
 class EncryptedPng(Png):
-    def __init__(self, file_png_name: str, public_key=None, private_key=None):
-        super().__init__(file_png_name)
+    def __init__(self, file_png_name: str, public_key=None, private_key=None, instrumentation=None, keystore=None):
+        """ Without keys, new ones are taken from keystore (keystore.KeyStore) or generated
+            The file is opened lazily, IDAT data is read while it is streamed
+            through the modes (see iter_idat_payloads)
+        """
+        super().__init__(file_png_name, lazy=True, instrumentation=instrumentation)
         if self.assert_file() == False:
             exit(1)
         idat_chunks = self.get_all_idat_chunks()
-        self.rsa_2048 = rsa2048(
-            idat_chunks, public_key=public_key, private_key=private_key)
+        self.rsa_2048 = rsa2048(idat_chunks, public_key=public_key, private_key=private_key,
+                                instrumentation=instrumentation, keystore=keystore)
         # self.encrypt_ecb()
         # self.build_png_from_chunks(
         # ".tmp/encrypted.png", pixels=self.rsa_2048.get_encrypted_pixels())
@@ -477,47 +1016,54 @@ class EncryptedPng(Png):
     def __str__(self) -> str:
         return super().__str__() + "Encrypted PNG created"
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """ Stops the RSA worker processes (see rsa2048.close) """
+        self.rsa_2048.close()
+
     def assert_file(self) -> bool:
-        if self.check_if_plte_exists() == True:
-            log.error("Encryption does not support PLTE!")
+        if self.get_color_type() == 3 and self.check_if_plte_exists() == False:
+            log.error("Indexed-colour image without PLTE!")
             return False
         return True
 
-    def encrypt_ecb(self, png_path_str: str):
-        data_to_encrypt = self.get_and_prepare_data_to_process()
-        self.rsa_2048.encrypt_all_data_ECB(data_to_encrypt)
+    @instrumented()
+    def encrypt_ecb(self, png_path_str: str, jobs: int = None):
+        """ jobs: RSA worker processes, defaults to the number of CPUs """
+        encrypted_pixels = self.rsa_2048.stream_encrypt_ECB(self.iter_pixel_data(), jobs)
+        self.write_pixel_stream(png_path_str, encrypted_pixels, after_iend_data=self.rsa_2048.get_extra_bytes)
         self.after_iend_data = self.rsa_2048.get_extra_bytes()
-        self.build_png_from_chunks(png_path_str, pixels=self.rsa_2048.get_encrypted_pixels(),
-                                   after_iend_data=self.rsa_2048.get_extra_bytes())
         return self.rsa_2048.get_private_key()
 
-    def decrypt_ecb(self, png_path_str: str):
+    @instrumented()
+    def decrypt_ecb(self, png_path_str: str, jobs: int = None):
+        """ jobs: RSA worker processes, defaults to the number of CPUs """
         extra_data = self.get_after_iend_data()
-        data_to_decrypt = self.get_and_prepare_data_to_process()
-        self.rsa_2048.decrypt_all_data_ECB(data_to_decrypt, extra_data)
-        self.replace_idat_chunks(self.rsa_2048.get_decrypted_chunks())
-        self.build_png_from_chunks(
-            png_path_str, pixels=self.rsa_2048.get_decrypted_pixels(), after_iend_data=b'')
+        decrypted_pixels = self.rsa_2048.stream_decrypt_ECB(self.iter_pixel_data(), extra_data, jobs)
+        self.write_pixel_stream(png_path_str, decrypted_pixels, after_iend_data=b'')
 
+    @instrumented()
     def encrypt_cfb(self, png_path_str: str):
-        data_to_encrypt = self.get_and_prepare_data_to_process()
-        iv, _ = self.rsa_2048.encrypt_all_data_CFB(data_to_encrypt)
-        self.after_iend_data = self.rsa_2048.get_extra_bytes()
-        self.build_png_from_chunks(png_path_str, pixels=self.rsa_2048.get_encrypted_pixels(),
-                                   after_iend_data=self.rsa_2048.get_extra_bytes())
+        iv = self.rsa_2048.make_iv_CFB()
+        encrypted_pixels = self.rsa_2048.stream_encrypt_CFB(self.iter_pixel_data(), iv)
+        self.after_iend_data = b''
+        self.write_pixel_stream(png_path_str, encrypted_pixels, after_iend_data=self.after_iend_data)
         public_key = self.rsa_2048.get_public_key()
         private_key = self.rsa_2048.get_private_key()
         return iv, public_key, private_key
 
-    def decrypt_cfb(self, png_path_str: str, iv: bytes):
-        extra_data = self.get_after_iend_data()
-        data_to_decrypt = self.get_and_prepare_data_to_process()
-        decrypted_pixels = self.rsa_2048.decrypt_all_data_CFB(
-            data_to_decrypt, iv)
-        # self.replace_idat_chunks(self.rsa_2048.get_decrypted_chunks())
-        self.build_png_from_chunks(
-            png_path_str, pixels=decrypted_pixels, after_iend_data=b'')
+    @instrumented()
+    def decrypt_cfb(self, png_path_str: str, iv: bytes, jobs: int = None):
+        """ jobs: RSA worker processes, defaults to the number of CPUs """
+        decrypted_pixels = self.rsa_2048.stream_decrypt_CFB(self.iter_pixel_data(), iv, jobs)
+        self.write_pixel_stream(png_path_str, decrypted_pixels, after_iend_data=b'')
 
+    @instrumented()
     def encrypt_aes_ecb(self, png_path_str, public_key):
         data_to_encrypt = self.get_and_prepare_data_to_process()
         extra, data = self.rsa_2048.encrypt_all_data_AES_ECB(
@@ -525,137 +1071,68 @@ class EncryptedPng(Png):
         self.build_png_from_chunks(png_path_str, pixels=data,
                                    after_iend_data=extra)
 
-    def build_png_from_chunks(self, file_name: str, pixels, after_iend_data) -> bool:
-        writer = self.get_png_writer()
-        print(self.get_width(), self.get_height())
-        row_width = self.get_width() * self.calculate_bytes_per_pixel()
-        pixels_by_rows = [pixels[i:i+row_width]
-                          for i in range(0, len(pixels), row_width)]
-        for row in pixels_by_rows:
-            if len(row) < row_width and type(row) == list:
-                row.extend([0]*(row_width-len(row)))
-        with open(file_name, 'wb') as f:
-            writer.write(f, pixels_by_rows)
-            # write after iend data as well
+    @instrumented()
+    def encrypt_aes_ctr(self, png_path_str: str):
+        """ RSA wrapped AES-CTR session key, stored after IEND """
+        encrypted_pixels = self.rsa_2048.stream_encrypt_AES_CTR(self.iter_pixel_data())
+        self.write_pixel_stream(png_path_str, encrypted_pixels, after_iend_data=self.rsa_2048.get_extra_bytes)
+        self.after_iend_data = self.rsa_2048.get_extra_bytes()
+        return self.rsa_2048.get_public_key(), self.rsa_2048.get_private_key()
+
+    @instrumented()
+    def decrypt_aes_ctr(self, png_path_str: str):
+        extra_data = self.get_after_iend_data()
+        decrypted_pixels = self.rsa_2048.stream_decrypt_AES_CTR(self.iter_pixel_data(), extra_data)
+        self.write_pixel_stream(png_path_str, decrypted_pixels, after_iend_data=b'')
+
+    @instrumented()
+    def write_pixel_stream(self, file_name, pixel_chunks, after_iend_data) -> bool:
+        """ Writes the image from pixel bytes coming in pieces of any size,
+            every piece of whole rows is filtered, compressed and written as
+            IDAT chunks fill up, so only about one piece and one IDAT chunk
+            are in memory
+            after_iend_data can be a function, called once the pixels are written
+            file_name can be a writable binary file object as well (see open_output)
+        """
+        row_width = self.get_stride()
+        with open_output(file_name) as f, self.get_png_encoder(f) as encoder:
+            for piece in iter_blocks(pixel_chunks, row_width):
+                encoder.write_rows(np.frombuffer(piece, dtype=np.uint8).reshape(-1, row_width))
+            encoder.finish()
+            if callable(after_iend_data):
+                after_iend_data = after_iend_data()
             f.write(after_iend_data)
         return True
 
-    def get_png_writer(self) -> png.Writer:
-        bytes_per_pixel = self.calculate_bytes_per_pixel()
-        bit_depth = self.get_bit_depth()
-        if bytes_per_pixel == 1:
-            png_writer = png.Writer(
-                self.get_width(), self.get_height(), greyscale=True, bitdepth=bit_depth)
-        elif bytes_per_pixel == 2:
-            png_writer = png.Writer(
-                self.get_width(), self.get_height(), greyscale=True, alpha=True, bitdepth=bit_depth)
-        elif bytes_per_pixel == 3:
-            png_writer = png.Writer(
-                self.get_width(), self.get_height(), greyscale=False, bitdepth=bit_depth)
-        elif bytes_per_pixel == 4:
-            png_writer = png.Writer(self.get_width(), self.get_height(),
-                                    greyscale=False, alpha=True, bitdepth=bit_depth)
-        else:
-            png_writer = png.Writer(self.get_width(), self.get_height(),
-                                    greyscale=False, alpha=True, bitdepth=bit_depth)
-        return png_writer
-
-    def get_bit_depth(self):
-        # get the bit_depth from ihdr chunk
-        return self.get_ihdr_chunk().get_hdr_data()["bit_depth"]
-
-    def get_color_type(self):
-        return self.get_ihdr_chunk().get_hdr_data()["color_type"]
-
-    def get_width(self):
-        return self.get_ihdr_chunk().get_hdr_data()["width"]
-
-    def get_height(self):
-        return self.get_ihdr_chunk().get_hdr_data()["height"]
-
-    def calculate_bytes_per_pixel(self):
-        color_type_to_bytes_per_pixel_ratio = {
-            0: 1,
-            2: 3,
-            3: 1,
-            4: 2,
-            6: 4
-        }
-        return color_type_to_bytes_per_pixel_ratio[self.get_color_type()]
-
-    def get_and_prepare_data_to_process(self):
-        all_idat_data = b''
-        for chunk_to_encrypt in self.get_all_idat_chunks():
-            all_idat_data += chunk_to_encrypt.get_chunk()
-        bytes_per_pixel = self.calculate_bytes_per_pixel()
-        width = self.get_width()
-        height = self.get_height()
-
-        all_idat_data = zlib.decompress(all_idat_data)
-        assert len(all_idat_data) == height * \
-            (1 + width * bytes_per_pixel), "Corrupted data"
-
-        return self.defilter_data(all_idat_data)
+    @instrumented()
+    def build_png_from_chunks(self, file_name, pixels, after_iend_data, filter_strategy=None,
+                              threads: int = 1) -> bool:
+        """ Writes the image from pixel bytes (packed scanlines), missing
+            bytes at the end are written as zeros
+            filter_strategy: see filters.FILTER_STRATEGIES, no filtering by default
+            threads: zlib compression threads (see encoder.PngEncoder)
+            file_name can be a writable binary file object as well (see open_output)
+        """
+        image_size = self.get_height() * self.get_stride()
+        scanlines = np.zeros(image_size, dtype=np.uint8)
+        if isinstance(pixels, list):
+            pixels = bytes(pixels)
+        pixels = np.frombuffer(pixels, dtype=np.uint8)[:image_size]
+        scanlines[:len(pixels)] = pixels
+        with open_output(file_name) as f, \
+                self.get_png_encoder(f, filter_strategy=filter_strategy, threads=threads) as encoder:
+            encoder.write_rows(scanlines.reshape(self.get_height(), self.get_stride()))
+            encoder.finish()
+            # write after iend data as well
+            f.write(after_iend_data)
+        return True
 
+    @instrumented()
     def defilter_data(self, data_to_defilter: bytes):
-        bytes_per_pixel = self.calculate_bytes_per_pixel()
-        width = self.get_width()
-        height = self.get_height()
-        stride = width * bytes_per_pixel
-
-        reconstructed_idat_data = b''
-
-        def paeth_predictor(a, b, c):
-            """The Paeth Predictor computes a simple linear function of the three neighboring pixels (left, above, upper left),
-            then chooses as predictor the neighboring pixel closest to the computed value.
-            This technique is due to Alan W. Paeth [1]."""
-            p = a + b - c
-            pa = abs(p - a)
-            pb = abs(p - b)
-            pc = abs(p - c)
-            if pa <= pb and pa <= pc:
-                Pr = a
-            elif pb <= pc:
-                Pr = b
-            else:
-                Pr = c
-            return Pr
-
-        def recon_a(r, c):
-            return reconstructed_idat_data[r * stride + c - bytes_per_pixel] if c >= bytes_per_pixel else 0
-
-        def recon_b(r, c):
-            return reconstructed_idat_data[(r-1) * stride + c] if r > 0 else 0
-
-        def recon_c(r, c):
-            return reconstructed_idat_data[(r-1) * stride + c - bytes_per_pixel] if r > 0 and c >= bytes_per_pixel else 0
-
-        i = 0
-        # print(stride * height, len(data_to_defilter))
-        for r in range(height):
-            filter_type = data_to_defilter[i]
-            i += 1
-            for c in range(stride):
-                filt_x = data_to_defilter[i]
-                i += 1
-                if filter_type == 0:  # None
-                    recon_x = filt_x
-                elif filter_type == 1:  # Sub
-                    recon_x = filt_x + recon_a(r, c)
-                elif filter_type == 2:  # Up
-                    recon_x = filt_x + recon_b(r, c)
-                elif filter_type == 3:  # Average
-                    recon_x = filt_x + (recon_a(r, c) + recon_b(r, c)) // 2
-                elif filter_type == 4:  # Paeth
-                    recon_x = filt_x + \
-                        paeth_predictor(
-                            recon_a(r, c), recon_b(r, c), recon_c(r, c))
-                else:
-                    log.error(filter_type)
-                    raise Exception('Invalid filter type')
-                reconstructed_idat_data += bytes([recon_x & 0xFF])
-                # print(i)
-        return reconstructed_idat_data
-    
+        """ Reconstructs decompressed IDAT data, returns pixel bytes without
+            the filter type bytes (see filters.unfilter_scanlines)
+        """
+        return self.unfilter_scanlines(data_to_defilter).tobytes()
+
     def return_keys(self):
         return self.rsa_2048.get_public_key(), self.rsa_2048.get_private_key()